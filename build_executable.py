@@ -12,6 +12,13 @@ import subprocess
 import site
 from pathlib import Path
 
+# Modules token_script_v3.py imports on first use rather than at start-up
+LAZY_IMPORTS = [
+    "tiktoken", "tiktoken_ext.openai_public", "nltk", "nltk.corpus", "bs4",
+    "esprima", "pycparser", "tree_sitter", "cssparser", "javalang", "black",
+    "pyflakes", "chardet", "construct", "pefile", "elftools", "capstone", "r2pipe",
+]
+
 def main():
     print("===== Code Prompt Optimizer Build Script =====")
     print(f"Platform: {platform.system()} {platform.release()}")
@@ -65,7 +72,9 @@ def main():
         try:
             sys.path.append(os.path.dirname(os.path.abspath(__file__)))
             import token_script_v3
-            if hasattr(token_script_v3, 'GHIDRA_HEADLESS_PATH') and token_script_v3.GHIDRA_HEADLESS_PATH:
+            # The script no longer probes for Ghidra on import
+            token_script_v3.find_ghidra()
+            if token_script_v3.GHIDRA_HEADLESS_PATH:
                 print(f"Found Ghidra at: {token_script_v3.GHIDRA_HEADLESS_PATH}")
                 print("Note: Ghidra will NOT be bundled with the executable.")
                 print("Users will need to install Ghidra separately to use the decompilation features.")
@@ -122,6 +131,10 @@ def main():
         nltk_path = f"{nltk_data_dir}{os.pathsep}nltk_data"
         cmd.extend(["--add-data", nltk_path])
     
+    # Libraries the script imports lazily are invisible to PyInstaller's analysis
+    for module in LAZY_IMPORTS:
+        cmd.extend(["--hidden-import", module])
+    
     # Add main script
     cmd.append("token_script_v3.py")
     
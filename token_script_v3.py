@@ -3,7 +3,7 @@ from tkinter import ttk, filedialog, scrolledtext, messagebox
 import os
 import re
 import sys  # Added missing sys import
-from typing import List, Tuple, Optional, Dict
+from typing import List, Tuple, Optional, Dict, Iterable, Iterator
 import pathlib
 from pathlib import Path
 import threading
@@ -16,37 +16,162 @@ import platform
 from ctypes import windll, byref, c_int, sizeof
 from PIL import Image, ImageTk  # Added PIL import for better icon handling
 import heapq  # For prioritizing code blocks
+import bisect
+import itertools
+import math
+import functools
+import operator
+import hashlib
+import sqlite3
+import codecs
+import mmap
+from array import array
+from collections import OrderedDict
 
-# Import new libraries as per the upgrade plan
-try:
-    import tiktoken
-    import nltk
-    from nltk.corpus import words
-    import ast
-    from bs4 import BeautifulSoup
-    import esprima
-    import pycparser
-    from tree_sitter import Language, Parser
-    import cssparser
-    import javalang
-    import black
-    import pyflakes
-    import chardet
-    import construct
+import ast
+import atexit
+import importlib
+import importlib.util
+
+class LazyModule:
+    """Stand-in for a heavy optional library, imported on first attribute access.
+    
+    The import (and its cost, recorded in IMPORT_TIMINGS) happens the first
+    time the code path that needs the library runs, so start-up only pays for
+    what the window itself uses. A missing library raises ImportError at that
+    point, which the caller handles like any other parse failure.
+    """
+    
+    def __init__(self, name: str):
+        self.__dict__['_lazy_name'] = name
+        self.__dict__['_lazy_module'] = None
+    
+    def _lazy_load(self):
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            name = self.__dict__['_lazy_name']
+            with _IMPORT_LOCK:
+                module = self.__dict__['_lazy_module']
+                if module is None:
+                    start = time.perf_counter()
+                    try:
+                        module = importlib.import_module(name)
+                    except ImportError as e:
+                        if name not in _IMPORT_FAILURES:
+                            _IMPORT_FAILURES.add(name)
+                            print(f"Warning: {name} could not be imported: {e}")
+                            print("Run 'pip install -r requirements.txt' to install all dependencies")
+                        raise
+                    finally:
+                        IMPORT_TIMINGS.setdefault(name, time.perf_counter() - start)
+                    self.__dict__['_lazy_module'] = module
+        return module
+    
+    def __getattr__(self, attr: str):
+        return getattr(self._lazy_load(), attr)
+    
+    def __repr__(self) -> str:
+        state = "loaded" if self.__dict__['_lazy_module'] is not None else "not loaded"
+        return f"<lazy module {self.__dict__['_lazy_name']!r} ({state})>"
+
+IMPORT_TIMINGS: Dict[str, float] = {}  # Module name -> seconds its first import took
+_IMPORT_FAILURES = set()
+_IMPORT_LOCK = threading.RLock()
+_STARTUP_BEGIN = time.perf_counter()
+
+@functools.lru_cache(maxsize=None)
+def is_module_available(name: str) -> bool:
+    """Check whether a library is installed without importing it."""
     try:
-        import pefile
-        import elftools
-        from capstone import *
-        import r2pipe
-    except ImportError:
-        pass  # Binary analysis libraries are optional
-except ImportError as e:
-    print(f"Warning: Some libraries could not be imported: {e}")
-    print("Run 'pip install -r requirements.txt' to install all dependencies")
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
+def print_import_report():
+    """Print how long start-up took and what each lazily imported library cost."""
+    print("Import-time report")
+    print(f"  {'start-up (script to window)':<30} {STARTUP_SECONDS * 1000:9.1f} ms")
+    if not IMPORT_TIMINGS:
+        print("  no optional libraries were imported")
+    for name, seconds in sorted(IMPORT_TIMINGS.items(), key=lambda item: item[1], reverse=True):
+        status = "failed" if name in _IMPORT_FAILURES else ""
+        print(f"  {name:<30} {seconds * 1000:9.1f} ms {status}")
+    print(f"  {'total lazy imports':<30} {sum(IMPORT_TIMINGS.values()) * 1000:9.1f} ms")
+
+STARTUP_SECONDS = 0.0  # Set by main() once the window is built
+
+# Heavy optional libraries, imported the first time their code path runs
+tiktoken = LazyModule('tiktoken')
+nltk = LazyModule('nltk')
+nltk_corpus = LazyModule('nltk.corpus')
+bs4 = LazyModule('bs4')
+esprima = LazyModule('esprima')
+pycparser = LazyModule('pycparser')
+tree_sitter = LazyModule('tree_sitter')
+cssparser = LazyModule('cssparser')
+javalang = LazyModule('javalang')
+black = LazyModule('black')
+pyflakes = LazyModule('pyflakes')
+chardet = LazyModule('chardet')
+construct = LazyModule('construct')
+# Binary analysis libraries are optional
+pefile = LazyModule('pefile')
+elftools = LazyModule('elftools')
+capstone = LazyModule('capstone')
+r2pipe = LazyModule('r2pipe')
 
 # Constants
 MAX_TOKEN_LIMIT = 2500
 MAX_TOKENS_PER_STEP = 500
+TOKEN_BATCH_THREADS = min(8, os.cpu_count() or 1)  # Worker threads for tiktoken's encode_batch
+TOKEN_CACHE_MAX_ENTRIES = 65536  # Distinct strings whose token counts are remembered
+TOKEN_CACHE_MAX_TOKEN_IDS = 4_000_000  # Token IDs kept in the cache across all entries
+LIVE_COUNT_DEBOUNCE_MS = 300  # Idle time after a keystroke before the prompt is recounted
+PYTHON_BLOCK_MODE = 'nested'  # 'top-level' for outermost definitions only, 'nested' to split classes into their members
+ENCODING_SAMPLE_BYTES = 64 * 1024  # Bytes of a file used to detect its encoding
+MMAP_MIN_FILE_BYTES = 16 * 1024 * 1024  # Files at least this large are memory-mapped instead of read into a buffer
+FALLBACK_SCAN_TIME_BUDGET = 2.0  # Seconds a structural fallback scan may spend on one file
+STEP_BATCH_FIRST = 8  # Blocks optimized (and encoded) together at first; batches then double
+STEP_BATCH_MAX = 256  # Largest batch, so work stops soon after the token limit is reached
+STEP_STREAM_INTERVAL = 0.25  # Seconds between output refreshes while steps are still being produced
+KNAPSACK_DP_MAX_CELLS = 1_000_000  # Blocks x budget tokens up to which block selection is solved exactly
+TRUNCATION_NOTE = "... [Additional content truncated due to token limit]"  # Last step when the budget is exceeded
+RELEVANT_BLOCKS_KEPT = MAX_TOKEN_LIMIT  # Each step costs at least one token, so no more blocks can reach the output
+BM25_K1 = 1.2  # Term-frequency saturation of repository relevance ranking
+BM25_B = 0.75  # How strongly block length normalizes repository relevance scores
+DEDUPLICATE_BLOCKS = True  # Skip blocks that repeat, or nest in or around, a block already chosen
+DEDUP_SIMILARITY = 0.8  # Estimated Jaccard similarity of token shingles at which two blocks are duplicates
+DEDUP_SHINGLE_TOKENS = 5  # Consecutive tokens per shingle
+DEDUP_SKETCH_BINS = 64  # MinHash bins per block sketch; a power of two
+DEDUP_LSH_BANDS = 16  # Bands the sketch is split into; only blocks sharing a band are compared
+DEDUP_BUCKET_MAX = 32  # Kept blocks compared per shared band; a band shared more widely is boilerplate
+BLOCK_INDEX_NAME = "block_index.sqlite3"  # Persistent span index, written next to tokenizer.log
+BLOCK_INDEX_MAX_BYTES = 256 * 1024 * 1024  # Stored spans beyond this evict the least recently used files
+PARSER_VERSION = 3  # Bump when extraction or comment stripping changes, to invalidate indexed spans and counts
+EXTRACT_PROCESSES = os.cpu_count() or 1  # Worker processes for repository mode
+COLLAPSE_WHITESPACE = True  # Output code on one line; when off, whitespace is kept and Python is formatted with black
+FORMAT_CODE = True  # Run CODE_FORMATTERS (black for Python) when whitespace is kept
+BLACK_CACHE_MAX_ENTRIES = 4096  # Formatted blocks remembered by content hash
+BLACK_POOL_MIN_BLOCKS = 8  # Fewer unformatted blocks than this are formatted in-process
+REPOSITORY_EXTENSIONS = {'.py', '.js', '.html', '.htm', '.css', '.java', '.c', '.h', '.cpp', '.hpp', '.txt'}  # Files read in repository mode
+TOKEN_ESTIMATE_MIN_INPUT_BYTES = 1_000_000  # Inputs larger than this are estimated until near the budget edge
+TOKEN_CALIBRATION_SAMPLE_BYTES = 64 * 1024  # Bytes per file type counted exactly to fit the estimator to the input
+TOKEN_CALIBRATION_CHUNKS = 16  # Pieces that sample is taken in, spread over the input
+
+# Starting UTF-8 bytes per cl100k_base token for whitespace-collapsed text, and
+# the relative error allowed around them. These are rough defaults, not
+# measurements: before estimates are used, calibrate_estimator() refits each file
+# type of the input from exact counts of samples of it.
+TOKEN_ESTIMATE_PROFILES = {
+    '.py': (3.6, 0.20),
+    '.js': (3.4, 0.22),
+    '.html': (3.0, 0.25),
+    '.css': (3.1, 0.25),
+    '.java': (3.8, 0.20),
+    '.c': (3.3, 0.22),
+    '.cpp': (3.3, 0.22),
+    '.txt': (4.2, 0.18),
+}
 
 # Dark theme colors
 DARK_THEME_BG = "#2d2d2d"
@@ -73,215 +198,1945 @@ THEME_ACCENT = DARK_THEME_ACCENT
 THEME_MENUBAR = DARK_THEME_MENUBAR  # Initialize with dark theme menu bar color
 
 GHIDRA_HEADLESS_PATH = ""  # Will be set if Ghidra is found
+ENVIRONMENT_PROFILE_NAME = "environment_profile.json"  # Cached discovery results, written next to tokenizer.log
+ENVIRONMENT_PROFILE_VERSION = 1  # Bump when the profile's contents change
+ENVIRONMENT_PROFILE: Dict = {}  # Set by load_environment_profile()
+_ENVIRONMENT_PROFILE_PATH = ""
+_ENVIRONMENT_PROFILE_LOCK = threading.Lock()
+BLOCK_INDEX = None  # BlockIndex opened by main(); None parses every file
+
+class GrammarRegistry:
+    """Tree-sitter grammars, each loaded the first time it is requested.
+    
+    Finding out which grammars exist only lists the grammar directory; a
+    grammar's shared library is loaded and its parser built on the first
+    get() for that language, and the result is cached for the process.
+    """
+    
+    def __init__(self, language_dir: str):
+        self.language_dir = language_dir
+        self._available = None  # Language name -> path of its compiled grammar
+        self._loaded = {}  # Language name -> {'language', 'parser'}, or None if loading failed
+        self._lock = threading.Lock()
+    
+    def available(self) -> Dict[str, str]:
+        """Map of language names to grammar files, without loading any of them."""
+        if self._available is None:
+            available = {}
+            try:
+                if os.path.isdir(self.language_dir):
+                    for lang_file in os.listdir(self.language_dir):
+                        if lang_file.endswith('.so'):
+                            lang_name = os.path.splitext(lang_file)[0].replace('tree-sitter-', '')
+                            available[lang_name] = os.path.join(self.language_dir, lang_file)
+            except Exception as e:
+                print(f"Tree-sitter initialization error: {e}")
+            self._available = available
+        return self._available
+    
+    def set_available(self, available: Dict[str, str]):
+        """Use a known grammar map (e.g. from the environment profile) instead of listing the directory."""
+        self._available = dict(available)
+    
+    def __contains__(self, lang_name: str) -> bool:
+        return lang_name in self.available()
+    
+    def get(self, lang_name: str) -> Optional[Dict]:
+        """Return the {'language', 'parser'} pair for a language, loading it if needed."""
+        if lang_name not in self._loaded:
+            with self._lock:
+                if lang_name not in self._loaded:
+                    self._loaded[lang_name] = self._load(lang_name)
+        return self._loaded[lang_name]
+    
+    def _load(self, lang_name: str) -> Optional[Dict]:
+        path = self.available().get(lang_name)
+        if path is None:
+            return None
+        try:
+            language = tree_sitter.Language(path, lang_name)
+            parser = tree_sitter.Parser()
+            parser.set_language(language)
+            return {'language': language, 'parser': parser}
+        except Exception as e:
+            print(f"Failed to load Tree-sitter language {lang_name}: {e}")
+            return None
+
+# Tree-sitter grammars are loaded on demand from this directory
+LANGUAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tree-sitter-grammars")
+PARSERS = GrammarRegistry(LANGUAGE_DIR)
+
+class TokenCache:
+    """Bounded LRU cache of token counts, and optionally token IDs, keyed by content hash.
+
+    Entries are evicted least-recently-used first once either the number of
+    entries or the total number of stored token IDs exceeds its bound.
+    """
+
+    def __init__(self, max_entries: int = TOKEN_CACHE_MAX_ENTRIES, max_token_ids: int = TOKEN_CACHE_MAX_TOKEN_IDS):
+        self.max_entries = max_entries
+        self.max_token_ids = max_token_ids
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (count, token IDs as array or None)
+        self._stored_token_ids = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(text: str) -> bytes:
+        """Content hash used as the cache key for a string."""
+        return hashlib.blake2b(text.encode('utf-8', errors='surrogatepass'), digest_size=16).digest()
+
+    def get(self, key: bytes, need_tokens: bool = False):
+        """Return the (count, token IDs) entry for key, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (need_tokens and entry[1] is None):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: bytes, count: int, tokens: Optional[List[int]] = None):
+        """Store a token count, and the token IDs if given."""
+        token_ids = array('I', tokens) if tokens is not None and len(tokens) <= self.max_token_ids else None
+        with self._lock:
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None and old_entry[1] is not None:
+                if token_ids is None:
+                    token_ids = old_entry[1]  # Keep IDs stored by an earlier encode
+                else:
+                    self._stored_token_ids -= len(old_entry[1])
+            self._entries[key] = (count, token_ids)
+            if token_ids is not None:
+                self._stored_token_ids += len(token_ids)
+            while self._entries and (len(self._entries) > self.max_entries
+                                     or self._stored_token_ids > self.max_token_ids):
+                _, (_, evicted_ids) = self._entries.popitem(last=False)
+                if evicted_ids is not None:
+                    self._stored_token_ids -= len(evicted_ids)
+
+    def stats(self) -> Dict[str, float]:
+        """Hit/miss statistics and current size of the cache."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self._entries),
+                'token_ids': self._stored_token_ids,
+            }
+
+    def peek(self, key: bytes) -> Optional[int]:
+        """Return the cached count for key without touching LRU order or statistics."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[0] if entry is not None else None
+
+    def clear(self):
+        """Drop every entry and reset the statistics."""
+        with self._lock:
+            self._entries.clear()
+            self._stored_token_ids = 0
+            self.hits = 0
+            self.misses = 0
+
+class TokenCounter:
+    """Token counting service backed by a process-wide cached tiktoken encoding.
+
+    The encoding is loaded once on first use and shared by every caller. The
+    batch methods hand whole lists to tiktoken's multi-threaded encode_batch,
+    so counting hundreds of blocks costs one call instead of hundreds. Results
+    go through a content-addressed TokenCache, so a string that is counted
+    again anywhere in the pipeline is not re-encoded.
+    """
+
+    def __init__(self, encoding_name: str = "cl100k_base", num_threads: int = TOKEN_BATCH_THREADS,
+                 cache: Optional[TokenCache] = None):
+        self.encoding_name = encoding_name
+        self.num_threads = num_threads
+        self.cache = cache if cache is not None else TokenCache()
+        self._encoding = None
+        self._load_failed = False
+        self._lock = threading.Lock()
+
+    @property
+    def encoding(self):
+        """The cached tiktoken encoding, or None if tiktoken is unavailable."""
+        if self._encoding is None and not self._load_failed:
+            with self._lock:
+                if self._encoding is None and not self._load_failed:
+                    try:
+                        self._encoding = tiktoken.get_encoding(self.encoding_name)
+                    except Exception as e:
+                        self._load_failed = True
+                        print(f"Tiktoken error: {e}. Falling back to basic tokenization.")
+        return self._encoding
+
+    def encode(self, text: str) -> List[int]:
+        """Encode a single string into token IDs."""
+        return self.encode_many([text])[0]
+
+    def encode_many(self, texts: List[str]) -> List[List[int]]:
+        """Encode a batch of strings in one multi-threaded call."""
+        return self._lookup(texts, need_tokens=True)
+
+    def count(self, text: str) -> int:
+        """Count the tokens in a single string."""
+        if self.encoding is None:
+            return len(text.split())
+        return self._lookup([text], need_tokens=False)[0]
+
+    def count_many(self, texts: List[str]) -> List[int]:
+        """Count the tokens of every string in a batch, preserving order."""
+        texts = list(texts)
+        if self.encoding is None:
+            return [len(text.split()) for text in texts]
+        return self._lookup(texts, need_tokens=False)
+
+    def _lookup(self, texts: List[str], need_tokens: bool) -> list:
+        """Serve texts from the cache and batch-encode each distinct miss once."""
+        encoding = self.encoding
+        if encoding is None:
+            raise RuntimeError("tiktoken encoding is not available")
+        texts = list(texts)
+        keys = [TokenCache.key(text) for text in texts]
+        results = [None] * len(texts)
+        pending = {}  # key -> (text, indexes of texts with that content)
+        for i, key in enumerate(keys):
+            if key in pending:
+                pending[key][1].append(i)
+                continue
+            entry = self.cache.get(key, need_tokens)
+            if entry is not None:
+                results[i] = list(entry[1]) if need_tokens else entry[0]
+            else:
+                pending[key] = (texts[i], [i])
+
+        if pending:
+            missing = [text for text, _ in pending.values()]
+            if len(missing) < 2:
+                encoded = [encoding.encode(text, disallowed_special=()) for text in missing]
+            else:
+                encoded = encoding.encode_batch(missing, num_threads=self.num_threads, disallowed_special=())
+            for (key, (_, indexes)), tokens in zip(pending.items(), encoded):
+                self.cache.put(key, len(tokens), tokens if need_tokens else None)
+                for i in indexes:
+                    results[i] = tokens if need_tokens else len(tokens)
+
+        return results
+
+    def cached_count(self, text: str) -> Optional[int]:
+        """Return the exact count for text if it has already been encoded, else None."""
+        return self.cache.peek(TokenCache.key(text))
+
+class TokenEstimator:
+    """Approximate token counts from UTF-8 byte length, calibrated per language.
+
+    Estimates cost one pass over the bytes and never touch the encoder. Each
+    language carries a relative error bound, so callers know how far an
+    estimate can be from the exact count and when an exact count is needed.
+    """
+
+    def __init__(self, profiles: Optional[Dict[str, Tuple[float, float]]] = None):
+        self.profiles = dict(profiles if profiles is not None else TOKEN_ESTIMATE_PROFILES)
+
+    def _profile(self, language: Optional[str]) -> Tuple[float, float]:
+        return self.profiles.get(language) or self.profiles['.txt']
+
+    def bytes_per_token(self, language: Optional[str] = None) -> float:
+        """Calibrated bytes per token for a language."""
+        return self._profile(language)[0]
+
+    def error_bound(self, language: Optional[str] = None) -> float:
+        """Relative error bound of estimates for a language."""
+        return self._profile(language)[1]
+
+    def estimate(self, text: str, language: Optional[str] = None) -> int:
+        """Estimate the number of tokens in text."""
+        if not text:
+            return 0
+        return max(1, math.ceil(len(text.encode('utf-8', errors='replace')) / self.bytes_per_token(language)))
+
+    def upper_bound(self, text: str, language: Optional[str] = None) -> int:
+        """Largest token count the estimate allows for text."""
+        return math.ceil(self.estimate(text, language) * (1 + self.error_bound(language)))
+
+    def calibrate(self, samples: Dict[str, List[str]], counter: 'TokenCounter'):
+        """Fit bytes-per-token ratios and error bounds from sample texts per language."""
+        for language, texts in samples.items():
+            texts = [text for text in texts if text]
+            if not texts:
+                continue
+            counts = counter.count_many(texts)
+            sizes = [len(text.encode('utf-8', errors='replace')) for text in texts]
+            if not sum(counts):
+                continue
+            ratio = sum(sizes) / sum(counts)
+            worst = max(abs(size / ratio - count) / max(count, 1) for size, count in zip(sizes, counts))
+            self.profiles[language] = (ratio, max(0.05, worst))
+
+TOKEN_COUNTER = TokenCounter()
+TOKEN_ESTIMATOR = TokenEstimator()
+
+def tokenize(text: str, exact: bool = True, language: Optional[str] = None) -> int:
+    """Count tokens using tiktoken (OpenAI's tokenizer), or estimate them.
+
+    Args:
+        text: Text to count
+        exact: If False, return a calibrated estimate without running the encoder
+        language: File type of text (e.g. '.py'), used to pick the estimate ratio
+    """
+    if not exact:
+        return TOKEN_ESTIMATOR.estimate(text, language)
+    return TOKEN_COUNTER.count(text)
+
+# Points where cl100k_base's pre-tokenizer never merges across: right after a
+# newline that is followed by a non-whitespace character
+_LIVE_SEGMENT_BOUNDARY = re.compile(r'(?<=\n)(?=\S)')
+
+class LiveTokenCounter:
+    """Exact token total for a large text that is edited a little at a time.
+
+    The text is cut into line-range segments at boundaries the tokenizer never
+    merges across, so the total is exactly the sum of the segment counts.
+    Counts are cached per segment content, so an edit only re-encodes the
+    segments it touched.
+    """
+
+    def __init__(self, counter: TokenCounter):
+        self.counter = counter
+        self._segment_counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def count(self, text: str) -> int:
+        """Count the tokens in text, re-encoding only segments not seen last time."""
+        segments = _LIVE_SEGMENT_BOUNDARY.split(text)
+        with self._lock:
+            previous = self._segment_counts
+            missing = list({segment for segment in segments if segment not in previous})
+            counts = {segment: previous[segment] for segment in segments if segment in previous}
+            counts.update(zip(missing, self.counter.count_many(missing)))
+            # Only keep the current segments so the cache stays bounded by the text size
+            self._segment_counts = counts
+        return sum(counts[segment] for segment in segments)
+
+def split_text_by_tokens(text: str, max_tokens: int, separators: Tuple[str, ...] = ("\n", " "),
+                         tokens: Optional[List[int]] = None) -> List[str]:
+    """Split text into chunks of at most max_tokens tokens using a single encode.
+
+    The text is encoded once and cut at token-index boundaries, each snapped back
+    to the last separator in the window (a line break is preferred over a space).
+    Splitting is linear in the size of the text.
+
+    Args:
+        text: Text to split
+        max_tokens: Maximum number of tokens per chunk
+        separators: Break characters to snap to, in order of preference
+        tokens: Optional token IDs of text, if they were already encoded
+
+    Returns:
+        List of chunks, each stripped of leading/trailing separators
+    """
+    if not text:
+        return []
+    strip_chars = "".join(separators)
+
+    encoding = TOKEN_COUNTER.encoding
+    if encoding is None:
+        # Without tiktoken a token is a whitespace-separated word
+        words = text.split()
+        if len(words) <= max_tokens:
+            return [text]
+        return [" ".join(words[i:i + max_tokens]) for i in range(0, len(words), max_tokens)]
+
+    if tokens is None:
+        tokens = TOKEN_COUNTER.encode(text)
+    if len(tokens) <= max_tokens:
+        return [text]
+
+    # Byte offset of every token boundary; offsets[i] is where token i starts
+    data = text.encode('utf-8')
+    offsets = list(itertools.accumulate((len(b) for b in encoding.decode_tokens_bytes(tokens)), initial=0))
+    separator_bytes = [sep.encode('utf-8') for sep in separators]
+
+    chunks = []
+    start = 0
+    total = len(tokens)
+    while start < total:
+        end = min(start + max_tokens, total)
+        if end < total:
+            end = _snap_token_boundary(data, offsets, start, end, separator_bytes)
+        chunk = data[offsets[start]:offsets[end]].decode('utf-8', errors='replace').strip(strip_chars)
+        if chunk:
+            chunks.append(chunk)
+        start = end
+
+    return chunks
+
+def _snap_token_boundary(data: bytes, offsets: List[int], start: int, end: int, separator_bytes: List[bytes]) -> int:
+    """Move a token boundary back to the last separator in the window.
+
+    The cut is made where the token holding the separator begins, so a
+    separator that the tokenizer attaches to the next word (" word") starts
+    the next chunk instead of splitting that word. A separator is only
+    preferred over the next one if cutting there keeps at least half of the
+    window, so a stray line break cannot produce tiny chunks.
+    """
+    # A separator at the very start of the window cannot end a chunk
+    low, high = offsets[start] + 1, offsets[end]
+    half = start + (end - start) // 2
+    best = None
+    for sep in separator_bytes:
+        pos = data.rfind(sep, low, high)
+        while pos != -1:
+            # First boundary at or after the separator's start that still fits the window
+            boundary = bisect.bisect_left(offsets, pos, start + 1, end + 1)
+            if boundary <= end:
+                if boundary >= half:
+                    return boundary
+                best = max(best or boundary, boundary)
+                break
+            pos = data.rfind(sep, low, pos)
+    if best is not None:
+        return best
+
+    # No separator in the window: hard cut, but never inside a multi-byte character
+    boundary = end
+    while boundary > start + 1 and offsets[boundary] < len(data) and (data[offsets[boundary]] & 0xC0) == 0x80:
+        boundary -= 1
+    return boundary
+
+def split_text_by_estimate(text: str, max_tokens: int, language: Optional[str] = None,
+                           separators: Tuple[str, ...] = ("\n", " ")) -> List[str]:
+    """Split text into chunks of about max_tokens tokens without encoding it.
+
+    Windows are sized from the calibrated bytes-per-token ratio, shrunk by the
+    language's error bound, then snapped back to a separator the same way
+    split_text_by_tokens does.
+    """
+    if not text:
+        return []
+    window = max(1, int(max_tokens * TOKEN_ESTIMATOR.bytes_per_token(language)
+                        * (1 - TOKEN_ESTIMATOR.error_bound(language))))
+    data = text.encode('utf-8', errors='replace')
+    if len(data) <= window:
+        return [text]
+
+    strip_chars = "".join(separators)
+    separator_bytes = [sep.encode('utf-8') for sep in separators]
+    chunks = []
+    start = 0
+    while start < len(data):
+        end = min(start + window, len(data))
+        if end < len(data):
+            cut = -1
+            for sep in separator_bytes:
+                pos = data.rfind(sep, start, end)
+                if pos != -1 and pos + len(sep) - start >= window // 2:
+                    cut = pos + len(sep)
+                    break
+            if cut == -1:
+                # Hard cut, but never inside a multi-byte character
+                while end > start + 1 and (data[end] & 0xC0) == 0x80:
+                    end -= 1
+            else:
+                end = cut
+        chunk = data[start:end].decode('utf-8', errors='replace').strip(strip_chars)
+        if chunk:
+            chunks.append(chunk)
+        start = end
+
+    return chunks
+
+def _growing_batches(iterable, first: int = STEP_BATCH_FIRST, largest: int = STEP_BATCH_MAX):
+    """Yield lists from an iterable in batches that double in size up to largest."""
+    iterator = iter(iterable)
+    size = first
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+        size = min(size * 2, largest)
+
+@functools.lru_cache(maxsize=None)
+def truncation_note_tokens() -> int:
+    """Exact token count of TRUNCATION_NOTE, counted once."""
+    return TOKEN_COUNTER.count(TRUNCATION_NOTE)
 
-# Ensure NLTK data is available
-try:
-    nltk.data.find('corpora/words')
-except LookupError:
+def _admit_counted(steps: List[str], total: int, limit: int, remaining: Iterator):
+    """Yield steps, counted exactly in one batch, while they fit under limit.
+    
+    Room for TRUNCATION_NOTE is kept under limit: a step that only fits by
+    using it is admitted only if it is the last one, which is checked by
+    drawing from remaining.
+    
+    Returns the new token total, or None after yielding TRUNCATION_NOTE for
+    the first step that does not fit.
+    """
+    note_tokens = truncation_note_tokens()
+    for i, (step, step_tokens) in enumerate(zip(steps, TOKEN_COUNTER.count_many(steps))):
+        if total + step_tokens + note_tokens > limit:
+            # The step needs the note's room, so it can only be the last step
+            if total + step_tokens > limit or i + 1 < len(steps) or next(remaining, None) is not None:
+                yield TRUNCATION_NOTE
+                return None
+        yield step
+        total += step_tokens
+    return total
+
+def iter_admitted_steps(candidates, limit: int, approximate: bool = False) -> Iterator[str]:
+    """Keep (step, file type) candidates in order until the token limit is reached.
+    
+    Steps are yielded as soon as they are admitted, and candidates are only
+    drawn until the first one that does not fit, so a generator feeding this
+    does no work past the budget. Every step is counted exactly before it is
+    yielded, so the steps, TRUNCATION_NOTE included, never exceed the limit. With approximate set,
+    steps are first gathered on the upper bound of their estimate and only
+    counted, in one batch, when the batch is full or the estimate reaches
+    the limit; a batch whose estimate fell short is cut where the exact
+    counts stop fitting.
+    
+    Args:
+        candidates: (step, file type) pairs in priority order
+        limit: Maximum total number of tokens
+        approximate: Gather steps on estimates instead of counting each batch as it is drawn
+    
+    Yields:
+        The steps that fit, followed by TRUNCATION_NOTE if any were dropped
+    """
+    total = 0
+    if not approximate:
+        batches = _growing_batches(candidates)
+        for batch in batches:
+            total = yield from _admit_counted([step for step, _ in batch], total, limit, batches)
+            if total is None:
+                return
+        return
+    
+    candidates = iter(candidates)
+    pending = []        # Steps admitted on their estimate, not yet counted or yielded
+    pending_upper = 0   # Upper bound of their tokens
+    batch_size = STEP_BATCH_FIRST
+    for step, language in candidates:
+        step_upper = TOKEN_ESTIMATOR.upper_bound(step, language)
+        pending.append(step)
+        pending_upper += step_upper
+        if total + pending_upper <= limit and len(pending) < batch_size:
+            continue
+        
+        # Near the budget edge, or a full batch: count the pending steps exactly
+        total = yield from _admit_counted(pending, total, limit, candidates)
+        if total is None:
+            return
+        pending = []
+        pending_upper = 0
+        batch_size = min(batch_size * 2, STEP_BATCH_MAX)
+    if pending:
+        yield from _admit_counted(pending, total, limit, candidates)
+
+def count_steps_with_error(steps: List[str], approximate: bool = False) -> Tuple[int, int]:
+    """Total tokens of steps and the error bound of that total.
+
+    Steps whose exact count is already cached, and TRUNCATION_NOTE, are
+    counted exactly; with approximate set the rest are estimated and
+    contribute to the error bound, which is zero when none remain. Without
+    it every step is counted exactly and the bound is zero.
+    """
+    if not approximate:
+        return sum(TOKEN_COUNTER.count_many(steps)), 0
+    # Steps no longer carry their language here, so use the loosest bound
+    worst_error = max(error for _, error in TOKEN_ESTIMATOR.profiles.values())
+    total = 0
+    error = 0.0
+    for step in steps:
+        cached = truncation_note_tokens() if step == TRUNCATION_NOTE else TOKEN_COUNTER.cached_count(step)
+        if cached is not None:
+            total += cached
+        else:
+            estimate = TOKEN_ESTIMATOR.estimate(step)
+            total += estimate
+            error += estimate * worst_error
+    return total, math.ceil(error)
+
+def knapsack_select(weights: List[int], values: List[float], capacity: int) -> List[int]:
+    """Indices of the items with the most total value whose weights fit capacity.
+    
+    Solved exactly by dynamic programming over capacities while items x
+    capacity stays within KNAPSACK_DP_MAX_CELLS. Larger inputs take items
+    greedily by value per unit of weight and then keep the better of that
+    and the most valuable single item, which is never worse than half the
+    optimum.
+    
+    Args:
+        weights: Positive integer weight of each item
+        values: Value of each item
+        capacity: Largest total weight allowed
+        
+    Returns:
+        Indices of the chosen items, in ascending order
+    """
+    fitting = [i for i, weight in enumerate(weights) if weight <= capacity and values[i] > 0]
+    if not fitting:
+        return []
+    
+    if len(fitting) * (capacity + 1) <= KNAPSACK_DP_MAX_CELLS:
+        best = [0.0] * (capacity + 1)  # Best value within each capacity
+        taken = []                     # Per item, the capacities at which it is taken
+        for i in fitting:
+            weight, value = weights[i], values[i]
+            row = bytearray(capacity + 1)
+            updated = best[:]
+            for c in range(weight, capacity + 1):
+                candidate = best[c - weight] + value
+                if candidate > updated[c]:
+                    updated[c] = candidate
+                    row[c] = 1
+            best = updated
+            taken.append(row)
+        chosen = []
+        c = capacity
+        for i, row in zip(reversed(fitting), reversed(taken)):
+            if row[c]:
+                chosen.append(i)
+                c -= weights[i]
+        return sorted(chosen)
+    
+    chosen = []
+    used = 0
+    for i in sorted(fitting, key=lambda i: (-values[i] / weights[i], i)):
+        if used + weights[i] <= capacity:
+            chosen.append(i)
+            used += weights[i]
+    best_single = max(fitting, key=lambda i: (values[i], -i))
+    if values[best_single] > sum(values[i] for i in chosen):
+        return [best_single]
+    return sorted(chosen)
+
+def should_estimate_tokens(prompt: str, code_blocks: List[str] = (), input_size: int = 0) -> bool:
+    """Whether an input is large enough to use token estimates away from the budget edge.
+    
+    input_size adds the size of input whose blocks are not listed, such as a
+    file whose blocks have not been extracted yet.
+    """
+    return len(prompt) + sum(len(block) for block in code_blocks) + input_size > TOKEN_ESTIMATE_MIN_INPUT_BYTES
+
+def sample_input_files(file_paths: Iterable[str]) -> Dict[str, List[str]]:
+    """Samples of the input's files by file type, for calibrate_estimator().
+    
+    Each file type contributes about TOKEN_CALIBRATION_SAMPLE_BYTES, read in
+    TOKEN_CALIBRATION_CHUNKS pieces of whole lines spread over its files and
+    over the length of each, so large files are never read whole.
+    """
+    by_type = {}
+    for path in file_paths:
+        by_type.setdefault(os.path.splitext(path)[1].lower(), []).append(path)
+    samples = {}
+    for file_type, paths in by_type.items():
+        picks = paths[::max(1, len(paths) // TOKEN_CALIBRATION_CHUNKS)][:TOKEN_CALIBRATION_CHUNKS]
+        per_file = max(1, TOKEN_CALIBRATION_CHUNKS // len(picks))
+        size = TOKEN_CALIBRATION_SAMPLE_BYTES // (len(picks) * per_file)
+        for path in picks:
+            try:
+                with open(path, 'rb') as f:
+                    length = os.fstat(f.fileno()).st_size
+                    for offset in range(0, length, max(size, length // per_file))[:per_file]:
+                        f.seek(offset)
+                        piece = f.read(size)
+                        if offset:
+                            piece = piece[piece.find(b'\n') + 1:]
+                        if offset + size < length:
+                            piece = piece[:piece.rfind(b'\n') + 1]
+                        if piece.strip():
+                            samples.setdefault(file_type, []).append(piece.decode('utf-8', errors='replace'))
+            except OSError:
+                continue
+    return samples
+
+def sample_texts(texts: List[str]) -> List[str]:
+    """Up to TOKEN_CALIBRATION_CHUNKS texts spread over a list, cut to TOKEN_CALIBRATION_SAMPLE_BYTES together."""
+    picks = texts[::max(1, len(texts) // TOKEN_CALIBRATION_CHUNKS)][:TOKEN_CALIBRATION_CHUNKS]
+    size = TOKEN_CALIBRATION_SAMPLE_BYTES // max(1, len(picks))
+    return [text[:size] for text in picks if text]
+
+def calibrate_estimator(samples: Dict[Optional[str], List[str]]):
+    """Refit TOKEN_ESTIMATOR from exact counts of samples of the input, by file type.
+    
+    Samples are stripped as their steps will be before they are counted. Does
+    nothing if no encoding is loaded, since the fallback word counts would
+    skew the fit.
+    """
+    if TOKEN_COUNTER.encoding is None:
+        return
+    TOKEN_ESTIMATOR.calibrate({file_type: [strip_code(text, file_type, COLLAPSE_WHITESPACE) for text in texts]
+                               for file_type, texts in samples.items()}, TOKEN_COUNTER)
+
+# Byte order marks, longest first so UTF-32 LE is not mistaken for UTF-16 LE
+_BOM_ENCODINGS = [
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+
+def _bom_encoding(sample: bytes) -> Optional[str]:
+    for bom, encoding in _BOM_ENCODINGS:
+        if sample.startswith(bom):
+            return encoding
+    return None
+
+def _is_utf8_prefix(sample: bytes) -> bool:
+    """True if the sample is valid UTF-8, allowing a sequence cut off at its end."""
     try:
-        nltk.download('words', quiet=True)
-    except:
-        print("Warning: NLTK words corpus could not be downloaded")
-
-# Initialize Tree-sitter if available
-PARSERS = {}
-try:
-    # This path would need to be adjusted based on where the compiled language files are stored
-    LANGUAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tree-sitter-grammars")
-    if os.path.exists(LANGUAGE_DIR):
-        for lang_file in os.listdir(LANGUAGE_DIR):
-            if lang_file.endswith('.so'):
-                lang_name = os.path.splitext(lang_file)[0].replace('tree-sitter-', '')
-                try:
-                    PARSERS[lang_name] = {
-                        'language': Language(os.path.join(LANGUAGE_DIR, lang_file), lang_name),
-                        'parser': Parser()
-                    }
-                    PARSERS[lang_name]['parser'].set_language(PARSERS[lang_name]['language'])
-                except Exception as e:
-                    print(f"Failed to load Tree-sitter language {lang_name}: {e}")
-except Exception as e:
-    print(f"Tree-sitter initialization error: {e}")
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return True
+    except UnicodeDecodeError:
+        return False
 
-def tokenize(text: str) -> int:
-    """Count tokens using tiktoken (OpenAI's tokenizer)."""
+def _chardet_encoding(sample: bytes) -> Optional[str]:
     try:
-        encoding = tiktoken.get_encoding("cl100k_base")
-        return len(encoding.encode(text))
-    except Exception as e:
-        print(f"Tiktoken error: {e}. Falling back to basic tokenization.")
-        return len(text.split())
+        encoding = chardet.detect(sample)['encoding']
+        return codecs.lookup(encoding).name if encoding else None
+    except Exception:
+        return None
+
+def detect_sample_encoding(sample: bytes) -> Optional[str]:
+    """Guess the encoding of a file from a bounded prefix of it.
+    
+    A byte order mark or a valid UTF-8 prefix settles it without chardet,
+    which only sees the sample when neither applies.
+    
+    Returns:
+        Codec name, or None if the sample does not look like text
+    """
+    encoding = _bom_encoding(sample)
+    if encoding:
+        return encoding
+    if b'\0' in sample:
+        return None  # NUL bytes without a UTF-16/32 BOM mean binary data
+    if _is_utf8_prefix(sample):
+        return 'utf-8'
+    return _chardet_encoding(sample)
 
 def detect_file_encoding(file_path: str) -> str:
-    """Detect the encoding of a file using chardet."""
+    """Detect the encoding of a file from its first ENCODING_SAMPLE_BYTES bytes."""
     try:
         with open(file_path, 'rb') as f:
-            result = chardet.detect(f.read())
-        return result['encoding'] or 'utf-8'
+            return detect_sample_encoding(f.read(ENCODING_SAMPLE_BYTES)) or 'utf-8'
     except Exception:
         return 'utf-8'  # Fallback to UTF-8
 
-def optimize_text(text: str, is_code: bool = False, file_type: str = None) -> str:
-    """Optimize text or code while reducing tokens."""
+def _read_and_decode(file_path: str):
+    """Read a file once and decode it; returns (data, content, encoding, stat).
+    
+    data is the raw bytes, or an mmap the caller must close; content is None
+    for binary files; stat is taken from the open file before reading it.
+    """
+    with open(file_path, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        if stat.st_size >= MMAP_MIN_FILE_BYTES:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            data = f.read()
+    try:
+        sample = data[:ENCODING_SAMPLE_BYTES]
+        encoding = detect_sample_encoding(sample)
+        if encoding is None:
+            return data, None, '', stat
+        
+        if encoding == 'utf-8':
+            try:
+                return data, str(data, 'utf-8'), 'utf-8', stat
+            except UnicodeDecodeError as e:
+                window = data[max(0, e.start - ENCODING_SAMPLE_BYTES // 2):e.start + ENCODING_SAMPLE_BYTES // 2]
+                encoding = _chardet_encoding(sample + window) or 'utf-8'
+        
+        return data, str(data, encoding, 'replace'), encoding, stat
+    except BaseException:
+        if isinstance(data, mmap.mmap):
+            data.close()
+        raise
+
+def read_source_file(file_path: str) -> Tuple[Optional[str], str, bool]:
+    """Read a file once, deciding whether it is binary and decoding it if not.
+    
+    Large files are memory-mapped and decoded straight from the mapping. The
+    encoding comes from a bounded sample; if a file that starts out as UTF-8
+    turns out not to be, chardet gets the sample plus the bytes around the
+    first invalid sequence.
+    
+    Args:
+        file_path: Path to the file
+        
+    Returns:
+        (content, encoding, is_binary); content is None for binary files
+    """
+    data, content, encoding, _ = _read_and_decode(file_path)
+    if isinstance(data, mmap.mmap):
+        data.close()
+    return content, encoding, content is None
+
+class SourceFile:
+    """The UTF-8 bytes of a source file, which CodeBlock spans point into.
+    
+    A UTF-8 file is used as it is on disk (memory-mapped when large); any
+    other encoding is transcoded to UTF-8 once when the file is opened. The
+    buffer always equals the decoded content encoded as UTF-8.
+    """
+    
+    __slots__ = ('path', 'encoding', '_buffer', 'size', 'mtime_ns', '_digest')
+    
+    def __init__(self, path: Optional[str], buffer, encoding: str = 'utf-8'):
+        self.path = path
+        self.encoding = encoding  # Encoding of the file on disk
+        self._buffer = buffer     # bytes or mmap holding UTF-8; None until a deferred file is read
+        self.size = None          # Size and modification time of the file when it was read
+        self.mtime_ns = None
+        self._digest = None
+    
+    @classmethod
+    def from_text(cls, path: Optional[str], content: str) -> 'SourceFile':
+        return cls(path, content.encode('utf-8', 'surrogatepass'))
+    
+    @classmethod
+    def deferred(cls, path: str) -> 'SourceFile':
+        """A file that was parsed elsewhere (e.g. in a worker process), read when a block is first decoded."""
+        return cls(path, None)
+    
+    @property
+    def buffer(self):
+        if self._buffer is None:
+            source, _ = open_source_file(self.path)
+            self._buffer = source._buffer if source is not None else b''
+            if source is not None:
+                self.encoding, self.size, self.mtime_ns = source.encoding, source.size, source.mtime_ns
+        return self._buffer
+    
+    def digest(self) -> bytes:
+        """Content hash of the UTF-8 buffer, computed once."""
+        if self._digest is None:
+            self._digest = hashlib.blake2b(self.buffer, digest_size=16).digest()
+        return self._digest
+    
+    def decode(self, start: int, end: int) -> str:
+        return str(self.buffer[start:end], 'utf-8', 'replace')
+    
+    def __len__(self) -> int:
+        return len(self.buffer)
+
+def open_source_file(file_path: str) -> Tuple[Optional[SourceFile], Optional[str]]:
+    """Read a file once, returning its SourceFile and its decoded content.
+    
+    Both are None for binary files. For UTF-8 files the SourceFile keeps the
+    bytes (or mapping) that were read; nothing is read from disk again.
+    """
+    data, content, encoding, stat = _read_and_decode(file_path)
+    if content is not None and encoding == 'utf-8':
+        if isinstance(data, mmap.mmap) and hasattr(mmap, 'MADV_DONTNEED'):
+            # Decoding touched every page; let the kernel drop them until a block is read
+            data.madvise(mmap.MADV_DONTNEED)
+        source = SourceFile(file_path, data)
+    else:
+        if isinstance(data, mmap.mmap):
+            data.close()
+        if content is None:
+            return None, None
+        source = SourceFile.from_text(file_path, content)
+        source.encoding = encoding
+    source.size = stat.st_size
+    source.mtime_ns = stat.st_mtime_ns
+    return source, content
+
+class CodeBlock:
+    """A code block stored as a byte span of its SourceFile.
+    
+    The block's text is only decoded when `text` is read, so holding many
+    blocks costs a few words each rather than a copy of the source. Blocks
+    whose parser produced new text (such as BeautifulSoup's serialized
+    elements) carry it detached instead, with the span covering that text.
+    """
+    
+    __slots__ = ('source', 'start', 'end', 'language', 'tokens', 'score', '_text', '_terms')
+    
+    def __init__(self, source: Optional[SourceFile], start: int, end: int, language: Optional[str] = None,
+                 text: Optional[str] = None):
+        self.source = source
+        self.start = start        # Byte offsets into source.buffer
+        self.end = end
+        self.language = language  # File extension, e.g. '.py'
+        self.tokens = None        # Token count of the block's optimized text, once counted
+        self.score = 0.0          # Relevance to the prompt's keywords
+        self._text = text
+        self._terms = None
+    
+    @classmethod
+    def detached(cls, text: str, language: Optional[str] = None, source: Optional[SourceFile] = None) -> 'CodeBlock':
+        return cls(source, 0, len(text.encode('utf-8', 'surrogatepass')), language, text)
+    
+    @property
+    def text(self) -> str:
+        if self._text is not None:
+            return self._text
+        return self.source.decode(self.start, self.end)
+    
+    @property
+    def terms(self) -> 'BlockTerms':
+        """The block's identifier sub-terms, computed from its text on first use."""
+        if self._terms is None:
+            self._terms = BlockTerms.from_text(self.text)
+        return self._terms
+    
+    @property
+    def path(self) -> Optional[str]:
+        return self.source.path if self.source is not None else None
+    
+    @property
+    def is_detached(self) -> bool:
+        """Whether the block carries its own text, so its span says nothing about its place in the source."""
+        return self._text is not None
+    
+    def __len__(self) -> int:
+        return self.end - self.start
+    
+    def __str__(self) -> str:
+        return self.text
+    
+    def __repr__(self) -> str:
+        return f"CodeBlock({self.path!r}, {self.start}, {self.end}, {self.language!r})"
+
+def block_text(block) -> str:
+    """Text of a block, whether it is a CodeBlock or a plain string."""
+    return block if isinstance(block, str) else block.text
+
+def parser_signature() -> str:
+    """Identifies everything that changes extraction results, for invalidating indexed spans.
+    
+    The index also holds token counts of the optimized blocks, so the
+    settings and formatter that shape optimized text are included too.
+    """
+    optional = ','.join(name for name in ('esprima', 'bs4', 'tree_sitter', 'black') if is_module_available(name))
+    return (f"{PARSER_VERSION};{PYTHON_BLOCK_MODE};{','.join(sorted(PARSERS.available()))};{optional};"
+            f"collapse={COLLAPSE_WHITESPACE};format={FORMAT_CODE}")
+
+def _make_index_entry(source: SourceFile, language: str, spans: list) -> Dict:
+    """Pack a file's block spans (and detached texts with their languages) into a picklable index entry."""
+    starts = array('q')
+    ends = array('q')
+    detached = []
+    for span in spans:
+        if isinstance(span, CodeBlock):
+            starts.append(span.start)
+            ends.append(span.end)
+            detached.append([span._text, span.language])
+        else:
+            starts.append(span[0])
+            ends.append(span[1])
+            detached.append(None)
+    return {
+        'size': source.size,
+        'mtime_ns': source.mtime_ns,
+        'digest': source.digest(),
+        'language': language,
+        'starts': starts.tobytes(),
+        'ends': ends.tobytes(),
+        'tokens': array('i', [-1]).tobytes() * len(starts),
+        'detached': json.dumps(detached) if any(item is not None for item in detached) else None,
+    }
+
+def _index_entry_spans(entry: Optional[Dict], source: SourceFile):
+    """The spans and token counts an index entry holds for source, or None if the file changed.
+    
+    An unchanged size and mtime are trusted as they are; otherwise the entry
+    is used only if the content hash still matches.
+    """
+    if entry is None or entry['size'] != source.size:
+        return None
+    if entry['mtime_ns'] != source.mtime_ns and entry['digest'] != source.digest():
+        return None
+    starts = array('q')
+    starts.frombytes(entry['starts'])
+    ends = array('q')
+    ends.frombytes(entry['ends'])
+    tokens = array('i')
+    tokens.frombytes(entry['tokens'])
+    detached = json.loads(entry['detached']) if entry['detached'] else None
+    spans = []
+    for i, (start, end) in enumerate(zip(starts, ends)):
+        if detached and detached[i] is not None:
+            text, language = detached[i]
+            spans.append(CodeBlock(source, start, end, language, text))
+        else:
+            spans.append((start, end))
+    return spans, tokens
+
+class BlockIndex:
+    """Persistent index of extracted block spans, in SQLite next to tokenizer.log.
+    
+    An entry holds one file's block spans, language and token counts, with
+    the size, mtime and content hash they were extracted from. A file whose
+    size and mtime are unchanged is served without hashing; otherwise its
+    hash decides. Entries from another parser_signature() are dropped when
+    the index is opened, and the least recently used entries are evicted
+    once the stored spans exceed max_bytes.
+    """
+    
+    _COLUMNS = ('size', 'mtime_ns', 'digest', 'language', 'starts', 'ends', 'tokens', 'detached')
+    
+    def __init__(self, path: str, max_bytes: int = BLOCK_INDEX_MAX_BYTES, parser_version: Optional[str] = None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.parser_version = parser_version or parser_signature()
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, parser_version TEXT, size INTEGER, "
+                "mtime_ns INTEGER, digest BLOB, language TEXT, starts BLOB, ends BLOB, tokens BLOB, "
+                "detached TEXT, nbytes INTEGER, last_used REAL)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS files_last_used ON files (last_used)")
+            removed = self._connection.execute("DELETE FROM files WHERE parser_version != ?",
+                                               (self.parser_version,)).rowcount
+        if removed:
+            print(f"Block index: dropped {removed} entries from another parser version")
+            self._vacuum()
+    
+    def get_entry(self, file_path: str) -> Optional[Dict]:
+        """The stored entry for a path, without checking it against the file."""
+        with self._lock:
+            row = self._connection.execute(
+                f"SELECT {', '.join(self._COLUMNS)} FROM files WHERE path = ?", (os.path.abspath(file_path),)).fetchone()
+        return dict(zip(self._COLUMNS, row)) if row else None
+    
+    def put_entries(self, entries: List[Tuple[str, Dict]]):
+        """Store (path, entry) pairs in one transaction, then evict if over max_bytes."""
+        if not entries:
+            return
+        now = time.time()
+        rows = []
+        for file_path, entry in entries:
+            nbytes = len(entry['starts']) * 2 + len(entry['tokens']) + len(entry['detached'] or '')
+            rows.append((os.path.abspath(file_path), self.parser_version)
+                        + tuple(entry[column] for column in self._COLUMNS) + (nbytes, now))
+        with self._lock, self._connection:
+            self._connection.executemany(
+                f"INSERT OR REPLACE INTO files VALUES ({', '.join('?' * (len(self._COLUMNS) + 4))})", rows)
+        self._evict()
+    
+    def touch(self, file_paths: Iterable[str]):
+        """Mark entries as used, for eviction order."""
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany("UPDATE files SET last_used = ? WHERE path = ?",
+                                         [(now, os.path.abspath(path)) for path in file_paths])
+    
+    def lookup(self, file_path: str, source: SourceFile):
+        """Spans and token counts for a file just read, or None if it is not indexed or has changed."""
+        entry = self.get_entry(file_path)
+        cached = _index_entry_spans(entry, source)
+        if cached is not None:
+            if entry['mtime_ns'] != source.mtime_ns:
+                entry['mtime_ns'] = source.mtime_ns  # Same content, touched file
+                self.put_entries([(file_path, entry)])
+            else:
+                self.touch([file_path])
+        return cached
+    
+    def store(self, file_path: str, source: SourceFile, language: str, spans: list):
+        """Index the spans just extracted from a file."""
+        if source.size is not None:
+            self.put_entries([(file_path, _make_index_entry(source, language, spans))])
+    
+    def record_tokens(self, blocks: Iterable[CodeBlock]):
+        """Save the token counts of counted blocks into their files' entries.
+        
+        Nothing is saved while no encoding is loaded: the counts are then
+        TokenCounter's word-count fallback, and a later session with a working
+        tokenizer would take them for real token counts.
+        """
+        if TOKEN_COUNTER.encoding is None:
+            return
+        by_path = {}
+        for block in blocks:
+            if block.tokens is not None and block.path and block._text is None:
+                by_path.setdefault(block.path, []).append(block)
+        updates = []
+        for file_path, file_blocks in by_path.items():
+            entry = self.get_entry(file_path)
+            source = file_blocks[0].source
+            if entry is None or (entry['size'], entry['mtime_ns']) != (source.size, source.mtime_ns):
+                continue
+            starts = array('q')
+            starts.frombytes(entry['starts'])
+            ends = array('q')
+            ends.frombytes(entry['ends'])
+            tokens = array('i')
+            tokens.frombytes(entry['tokens'])
+            positions = {span: i for i, span in enumerate(zip(starts, ends))}
+            for block in file_blocks:
+                i = positions.get((block.start, block.end))
+                if i is not None:
+                    tokens[i] = block.tokens
+            updates.append((tokens.tobytes(), os.path.abspath(file_path)))
+        if updates:
+            with self._lock, self._connection:
+                self._connection.executemany("UPDATE files SET tokens = ? WHERE path = ?", updates)
+    
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            entries, stored = self._connection.execute("SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM files").fetchone()
+        return {'entries': entries, 'bytes': stored}
+    
+    def clear(self):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM files")
+        self._vacuum()
+    
+    def _evict(self):
+        with self._lock:
+            stored = self._connection.execute("SELECT COALESCE(SUM(nbytes), 0) FROM files").fetchone()[0]
+            if stored <= self.max_bytes:
+                return
+            # Drop the least recently used entries down to 90% of the limit
+            excess = stored - self.max_bytes * 9 // 10
+            doomed = []
+            for path, nbytes in self._connection.execute("SELECT path, nbytes FROM files ORDER BY last_used"):
+                if excess <= 0:
+                    break
+                doomed.append((path,))
+                excess -= nbytes
+            with self._connection:
+                self._connection.executemany("DELETE FROM files WHERE path = ?", doomed)
+        self._vacuum()
+    
+    def _vacuum(self):
+        with self._lock:
+            self._connection.execute("PRAGMA incremental_vacuum")
+
+class _PrefetchedIndex:
+    """BlockIndex stand-in for worker processes.
+    
+    Serves the one entry the parent looked up and keeps the entry that
+    should be stored instead of writing it, since only the parent process
+    talks to the database.
+    """
+    
+    def __init__(self, entry: Optional[Dict]):
+        self.entry = entry
+        self.stored = None  # Entry for the parent to store, if the file was parsed or touched
+    
+    def lookup(self, file_path: str, source: SourceFile):
+        cached = _index_entry_spans(self.entry, source)
+        if cached is not None and self.entry['mtime_ns'] != source.mtime_ns:
+            self.stored = dict(self.entry, mtime_ns=source.mtime_ns)
+        return cached
+    
+    def store(self, file_path: str, source: SourceFile, language: str, spans: list):
+        if source.size is not None:
+            self.stored = _make_index_entry(source, language, spans)
+
+def open_block_index(application_path: str) -> Optional[BlockIndex]:
+    """Open the block index next to tokenizer.log, or return None if it cannot be used."""
+    try:
+        return BlockIndex(os.path.join(application_path, BLOCK_INDEX_NAME))
+    except Exception as e:
+        print(f"Warning: Block index unavailable, files will be parsed on every run: {e}")
+        return None
+
+def _char_spans_to_bytes(content: str, spans: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """Convert character spans of content to byte spans of its UTF-8 encoding."""
+    if content.isascii():
+        return list(spans)
+    offsets = {}
+    byte_offset = 0
+    previous = 0
+    for position in sorted({position for span in spans for position in span}):
+        byte_offset += len(content[previous:position].encode('utf-8', 'surrogatepass'))
+        offsets[position] = byte_offset
+        previous = position
+    return [(offsets[start], offsets[end]) for start, end in spans]
+
+def _strip_span(content: str, start: int, end: int) -> Tuple[int, int]:
+    """Narrow a span so it excludes leading and trailing whitespace, like str.strip()."""
+    while start < end and content[start].isspace():
+        start += 1
+    while end > start and content[end - 1].isspace():
+        end -= 1
+    return start, end
+
+def load_word_list() -> set:
+    """Load the NLTK words corpus for autocomplete, downloading it if missing.
+    
+    Meant to run off the UI thread. When the environment profile already
+    records the corpus as present it is read directly; otherwise it is looked
+    up (and downloaded if needed) and the outcome is saved to the profile.
+    """
+    if ENVIRONMENT_PROFILE.get('nltk_words'):
+        try:
+            return set(nltk_corpus.words.words())
+        except LookupError:
+            pass  # Corpus was removed since the profile was written
+    
+    # Ensure NLTK data is available
+    try:
+        nltk.data.find('corpora/words')
+    except LookupError:
+        try:
+            nltk.download('words', quiet=True)
+        except:
+            print("Warning: NLTK words corpus could not be downloaded")
+    
+    try:
+        word_list = set(nltk_corpus.words.words())
+    except LookupError:
+        update_environment_profile(nltk_words=False)
+        raise
+    update_environment_profile(nltk_words=True)
+    return word_list
+
+# String literal syntax, matched so that comment markers inside strings are left alone
+_STRING_SYNTAX = {
+    'python': r"'''[^']*(?:'(?!'')[^']*)*'''|\"\"\"[^\"]*(?:\"(?!\"\")[^\"]*)*\"\"\""
+              r"|'[^'\\\n]*(?:\\.[^'\\\n]*)*'|\"[^\"\\\n]*(?:\\.[^\"\\\n]*)*\"",
+    'c': r"'[^'\\\n]*(?:\\.[^'\\\n]*)*'|\"[^\"\\\n]*(?:\\.[^\"\\\n]*)*\"",
+    'js': r"'[^'\\\n]*(?:\\.[^'\\\n]*)*'|\"[^\"\\\n]*(?:\\.[^\"\\\n]*)*\"|`[^`\\]*(?:\\[\s\S][^`\\]*)*`",
+}
+_COMMENT_SYNTAX = {
+    'hash': r'#[^\n]*',
+    'line': r'//[^\n]*',
+    'block': r'/\*[\s\S]*?\*/',
+    'html': r'<!--[\s\S]*?-->',
+}
+# File type -> (string syntax, comment syntaxes); other types get the generic entry
+CODE_SYNTAX = {
+    '.py': ('python', ('hash',)),
+    '.js': ('js', ('line', 'block')),
+    '.java': ('c', ('line', 'block')),
+    '.c': ('c', ('line', 'block')),
+    '.h': ('c', ('line', 'block')),
+    '.cpp': ('c', ('line', 'block')),
+    '.hpp': ('c', ('line', 'block')),
+    '.css': ('c', ('block',)),
+    '.html': (None, ('html',)),
+    '.htm': (None, ('html',)),
+    '.txt': (None, ()),  # Prose: no comments, only whitespace is collapsed
+    None: ('c', ('hash', 'html', 'block', 'line')),
+}
+_COMMENT_MARKERS = {'hash': '#', 'line': '//', 'block': '/*', 'html': '<!--'}
+_WHITESPACE_RUN = re.compile(r'\s+')
+
+@functools.lru_cache(maxsize=None)
+def _code_scanner(file_type: Optional[str]):
+    """A regex matching a language's string literals and comments, and the comment markers.
+    
+    Substituting each match with its 'string' group keeps literals and
+    drops comments in one scan (a function replacement is cheaper here
+    than a group template); the lookahead lets the scan skip every
+    position that cannot start either.
+    """
+    strings, comments = CODE_SYNTAX.get(file_type, CODE_SYNTAX[None])
+    markers = tuple(_COMMENT_MARKERS[name] for name in comments)
+    if not markers:
+        return None, markers  # Nothing to strip, so strip_code() never scans
+    starts = set(marker[0] for marker in markers)
+    if strings:
+        starts.update("'\"`" if strings == 'js' else "'\"")
+    string = _STRING_SYNTAX[strings] if strings else '(?!)'
+    comment = '|'.join(_COMMENT_SYNTAX[name] for name in comments)
+    first = ''.join(re.escape(char) for char in sorted(starts))
+    return re.compile(f'(?=[{first}])(?:(?P<string>{string})|{comment})'), markers
+
+def _kept_string(match) -> str:
+    """Replacement for _code_scanner() matches: string literals stay, comments go."""
+    return match.group('string') or ''
+
+def strip_code(text: str, file_type: Optional[str] = None, collapse_whitespace: bool = True,
+               stats: Optional[Dict[str, int]] = None) -> str:
+    """Remove comments from code and normalize its whitespace.
+    
+    Comment and string syntax come from CODE_SYNTAX, so '#' only starts a
+    comment where the language says it does and neither '#' nor '//' inside
+    a string literal is touched. Comments go in one scan (skipped when the
+    block has no comment marker at all) and whitespace runs are collapsed
+    in a second.
+    
+    Args:
+        text: Code to strip
+        file_type: File extension selecting the language's syntax
+        collapse_whitespace: Turn every whitespace run into one space and
+            strip the ends; otherwise only comments are removed
+        stats: Optional dict whose 'bytes_in', 'bytes_out' and
+            'comment_bytes' totals are increased by this call
+            
+    Returns:
+        The stripped code
+    """
+    scanner, markers = _code_scanner(file_type)
+    result = text
+    if any(marker in text for marker in markers):
+        result = scanner.sub(_kept_string, text)
+    if stats is not None:
+        bytes_in = len(text.encode('utf-8', 'surrogatepass'))
+        stats['bytes_in'] = stats.get('bytes_in', 0) + bytes_in
+        stats['comment_bytes'] = stats.get('comment_bytes', 0) + bytes_in - len(result.encode('utf-8', 'surrogatepass'))
+    if collapse_whitespace:
+        result = _WHITESPACE_RUN.sub(' ', result).strip()
+    if stats is not None:
+        stats['bytes_out'] = stats.get('bytes_out', 0) + len(result.encode('utf-8', 'surrogatepass'))
+    return result
+
+_BLACK_CACHE = OrderedDict()  # blake2b digest of a block -> black's output, or None if black rejected it
+_BLACK_CACHE_LOCK = threading.Lock()
+_BLACK_POOL = None
+
+def _black_format(text: str) -> Optional[str]:
+    """Process-pool worker: text formatted by black, or None if black cannot parse it."""
+    try:
+        return black.format_str(text, mode=black.Mode())
+    except Exception:
+        return None
+
+def _black_pool():
+    """The process pool black runs in, started on first use and kept for the session."""
+    global _BLACK_POOL
+    if _BLACK_POOL is None:
+        from concurrent.futures import ProcessPoolExecutor
+        _BLACK_POOL = ProcessPoolExecutor(max_workers=EXTRACT_PROCESSES, initializer=_init_extract_worker)
+    return _BLACK_POOL
+
+def format_python_blocks(texts: List[str]) -> List[str]:
+    """Format Python blocks with black, returning blocks black rejects unchanged.
+    
+    Results are memoized by content hash, so a block is formatted once per
+    session however often it is optimized. When at least
+    BLACK_POOL_MIN_BLOCKS distinct blocks are not cached they are formatted
+    across a process pool.
+    """
+    keys = [hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest() for text in texts]
+    results = [None] * len(texts)
+    pending = {}  # key -> indexes of texts with that content
+    with _BLACK_CACHE_LOCK:
+        for i, key in enumerate(keys):
+            if key in _BLACK_CACHE:
+                _BLACK_CACHE.move_to_end(key)
+                results[i] = _BLACK_CACHE[key]
+            else:
+                pending.setdefault(key, []).append(i)
+    
+    if pending:
+        missing = [texts[indexes[0]] for indexes in pending.values()]
+        formatted = None
+        if len(missing) >= BLACK_POOL_MIN_BLOCKS and EXTRACT_PROCESSES > 1:
+            try:
+                chunksize = max(1, len(missing) // (EXTRACT_PROCESSES * 4))
+                formatted = list(_black_pool().map(_black_format, missing, chunksize=chunksize))
+            except Exception as e:
+                print(f"Warning: Formatting process pool failed, formatting in-process: {e}")
+        if formatted is None:
+            formatted = [_black_format(text) for text in missing]
+        with _BLACK_CACHE_LOCK:
+            for (key, indexes), output in zip(pending.items(), formatted):
+                _BLACK_CACHE[key] = output
+                for i in indexes:
+                    results[i] = output
+            while len(_BLACK_CACHE) > BLACK_CACHE_MAX_ENTRIES:
+                _BLACK_CACHE.popitem(last=False)
+    
+    return [text if output is None else output for text, output in zip(texts, results)]
+
+# File type -> batch formatter applied to its blocks when whitespace is kept
+CODE_FORMATTERS = {'.py': format_python_blocks}
+
+def optimize_code_blocks(blocks: List[Tuple[str, Optional[str]]],
+                         stats: Optional[Dict[Optional[str], Dict[str, int]]] = None) -> List[str]:
+    """optimize_text() for a batch of (code, file type) pairs, formatting the Python ones together.
+    
+    Formatters from CODE_FORMATTERS (black for Python) only run when
+    FORMAT_CODE is set and COLLAPSE_WHITESPACE is off: their layout would otherwise be collapsed
+    into single spaces straight away. stats, if given, maps each file type
+    to the strip_code() byte totals of its blocks.
+    """
+    optimized = [strip_code(text, file_type, COLLAPSE_WHITESPACE,
+                            stats.setdefault(file_type, {}) if stats is not None else None) if text else ""
+                 for text, file_type in blocks]
+    if COLLAPSE_WHITESPACE:
+        return optimized
+    optimized = [text.strip() for text in optimized]
+    if not FORMAT_CODE:
+        return optimized
+    by_formatter = {}
+    for i, (_, file_type) in enumerate(blocks):
+        formatter = CODE_FORMATTERS.get(file_type)
+        if formatter is not None and optimized[i]:
+            by_formatter.setdefault(formatter, []).append(i)
+    for formatter, indexes in by_formatter.items():
+        for i, formatted in zip(indexes, formatter([optimized[i] for i in indexes])):
+            optimized[i] = formatted.strip()
+    return optimized
+
+def optimize_text(text: str, is_code: bool = False, file_type: str = None,
+                  stats: Optional[Dict[Optional[str], Dict[str, int]]] = None) -> str:
+    """Optimize text or code while reducing tokens.
+    
+    stats, if given, receives strip_code()'s byte totals for code, by file type.
+    """
     if not text:
         return ""
         
-    # First apply basic optimization
+    # Remove comments and normalize whitespace (see optimize_code_blocks())
     if is_code:
-        # Remove comments based on file type
-        text = re.sub(r'#.*$', '', text, flags=re.MULTILINE)  # Python comments
-        text = re.sub(r'<!--[\s\S]*?-->', '', text)  # HTML comments
-        text = re.sub(r'/\*[\s\S]*?\*/', '', text)  # CSS/JS multi-line comments
-        text = re.sub(r'//.*$', '', text, flags=re.MULTILINE)  # JS/C/Java single-line comments
-        
-        # Apply more advanced formatting if available
-        if file_type == '.py':
-            try:
-                text = black.format_str(text, mode=black.Mode())
-            except:
-                pass  # Fall back to basic formatting
-        
-        # Normalize whitespace
-        text = re.sub(r'\s+', ' ', text.strip())
-        return text
+        return optimize_code_blocks([(text, file_type)], stats)[0]
     
     # For natural language text
     text = re.sub(r'\s+', ' ', text.strip())
     return text
 
-def extract_with_tree_sitter(content: str, lang_name: str) -> List[str]:
-    """Extract code blocks using Tree-sitter."""
-    if lang_name not in PARSERS:
+def describe_strip_stats(stats: Dict[Optional[str], Dict[str, int]]) -> str:
+    """One line naming the bytes strip_code() saved per file type, largest saving first."""
+    saved = {file_type: totals['bytes_in'] - totals['bytes_out']
+             for file_type, totals in stats.items() if totals.get('bytes_in')}
+    parts = []
+    for file_type in sorted(saved, key=saved.get, reverse=True):
+        size = f"{saved[file_type]} B" if saved[file_type] < 1024 else f"{saved[file_type] / 1024:.1f} KB"
+        parts.append(f"{file_type or 'text'} {size} ({saved[file_type] / stats[file_type]['bytes_in']:.0%})")
+    return "Stripping saved " + ", ".join(parts) if parts else ""
+
+# Node types captured as blocks for each Tree-sitter grammar
+TREE_SITTER_NODE_TYPES = {
+    'python': ['function_definition', 'class_definition'],
+    'javascript': ['function_declaration', 'generator_function_declaration', 'class_declaration',
+                   'method_definition'],
+    'java': ['class_declaration', 'interface_declaration', 'enum_declaration', 'method_declaration',
+             'constructor_declaration'],
+    'c': ['function_definition', 'struct_specifier'],
+    'cpp': ['function_definition', 'class_specifier', 'struct_specifier'],
+}
+# Captured node types whose nested captures are returned as blocks of their own
+TREE_SITTER_CONTAINER_TYPES = {'class_definition', 'class_declaration', 'interface_declaration',
+                               'enum_declaration', 'class_specifier', 'struct_specifier'}
+TREE_SITTER_TREE_CACHE_SIZE = 32  # Parsed files kept for incremental reparsing
+
+_TREE_SITTER_QUERIES = {}
+_TREE_SITTER_TREES = OrderedDict()  # (language, file path) -> (source bytes, tree)
+
+def _tree_sitter_query(lang_name: str, grammar: Dict):
+    """Compile (once) a query capturing every block node type the grammar knows."""
+    if lang_name not in _TREE_SITTER_QUERIES:
+        language = grammar['language']
+        patterns = []
+        for node_type in TREE_SITTER_NODE_TYPES.get(lang_name, []):
+            try:
+                language.query(f"({node_type}) @block")
+                patterns.append(f"({node_type}) @block")
+            except Exception:
+                pass  # Node type not in this grammar version
+        _TREE_SITTER_QUERIES[lang_name] = language.query("\n".join(patterns)) if patterns else None
+    return _TREE_SITTER_QUERIES[lang_name]
+
+def _common_prefix_length(a: memoryview, b: memoryview, limit: int) -> int:
+    """Length of the common prefix of a and b, up to limit, by binary search over memcmp."""
+    low, high = 0, limit
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+def _byte_point(data: bytes, offset: int) -> Tuple[int, int]:
+    """(row, column) of a byte offset, as Tree-sitter expects for edits."""
+    row = data.count(b'\n', 0, offset)
+    return row, offset - (data.rfind(b'\n', 0, offset) + 1)
+
+def _parse_incrementally(lang_name: str, grammar: Dict, data: bytes, file_path: Optional[str]):
+    """Parse data, reusing the previous tree of the same file when there is one.
+    
+    The change since the last parse is described as a single edit (the region
+    between the common prefix and the common suffix), so Tree-sitter only
+    re-parses the part of the file that actually changed.
+    """
+    parser = grammar['parser']
+    key = (lang_name, file_path)
+    cached = _TREE_SITTER_TREES.pop(key, None) if file_path else None
+    
+    if cached is None:
+        tree = parser.parse(data)
+    else:
+        old_data, old_tree = cached
+        if old_data == data:
+            tree = old_tree
+        else:
+            old_view, new_view = memoryview(old_data), memoryview(data)
+            shortest = min(len(old_data), len(data))
+            start = _common_prefix_length(old_view, new_view, shortest)
+            suffix = _common_prefix_length(old_view[::-1], new_view[::-1], shortest - start)
+            old_end, new_end = len(old_data) - suffix, len(data) - suffix
+            old_tree.edit(start, old_end, new_end,
+                          _byte_point(old_data, start), _byte_point(old_data, old_end), _byte_point(data, new_end))
+            tree = parser.parse(data, old_tree)
+    
+    if file_path:
+        _TREE_SITTER_TREES[key] = (data, tree)
+        while len(_TREE_SITTER_TREES) > TREE_SITTER_TREE_CACHE_SIZE:
+            _TREE_SITTER_TREES.popitem(last=False)
+    return tree
+
+def extract_with_tree_sitter(content: str, lang_name: str, file_path: Optional[str] = None) -> List[str]:
+    """Extract code blocks using Tree-sitter queries over the whole syntax tree.
+    
+    Args:
+        content: Source code
+        lang_name: Tree-sitter language name
+        file_path: Optional path of the source; when given, the parsed tree is
+            kept so the next extraction of the same file reparses incrementally
+        
+    Returns:
+        List of code blocks; definitions nested in classes are returned on their
+        own and the class keeps only the text around them
+    """
+    data = bytes(content, 'utf-8')
+    return [data[start:end].decode('utf-8', errors='replace')
+            for start, end in tree_sitter_spans(data, lang_name, file_path)]
+
+def tree_sitter_spans(data: bytes, lang_name: str, file_path: Optional[str] = None) -> List[Tuple[int, int]]:
+    """Byte spans of the blocks extract_with_tree_sitter() would return for UTF-8 source data."""
+    grammar = PARSERS.get(lang_name)
+    if grammar is None:
+        return []
+    query = _tree_sitter_query(lang_name, grammar)
+    if query is None:
         return []
+    
+    tree = _parse_incrementally(lang_name, grammar, data, file_path)
+    captures = sorted({(node.start_byte, node.end_byte, node.type) for node, _ in query.captures(tree.root_node)},
+                      key=lambda capture: (capture[0], -capture[1]))
+    
+    # Keep captures unless they sit inside a function, whose body stays whole
+    spans = []
+    enclosing = []  # (end, inside a non-container capture)
+    for start, end, node_type in captures:
+        while enclosing and enclosing[-1][0] <= start:
+            enclosing.pop()
+        inside_function = bool(enclosing) and enclosing[-1][1]
+        enclosing.append((end, inside_function or node_type not in TREE_SITTER_CONTAINER_TYPES))
+        if not inside_function:
+            spans.append((start, end))
+    
+    return _split_nested_spans(data, spans)
+
+_PYTHON_DEFINITIONS = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+
+def extract_python_spans(content: str, mode: str = PYTHON_BLOCK_MODE) -> List[Tuple[int, int]]:
+    """Find function and class definitions in Python source in a single AST pass.
+    
+    Spans cover whole lines, from the first decorator to the definition's
+    end_lineno, so no subtree has to be walked again to find where it ends.
+    
+    Args:
+        content: Python source code
+        mode: 'top-level' to return only definitions that are not inside another
+            definition, or 'nested' to also return the members of classes; in
+            nested mode a class only keeps the lines not covered by its members,
+            so no line appears in two blocks (functions defined inside functions
+            stay part of the enclosing function)
         
-    parser = PARSERS[lang_name]['parser']
-    tree = parser.parse(bytes(content, 'utf-8'))
-    root = tree.root_node
-    
-    # Get relevant node types based on language
-    node_types = {
-        'python': ['function_definition', 'class_definition'],
-        'javascript': ['function_declaration', 'class_declaration', 'arrow_function'],
-        'java': ['method_declaration', 'class_declaration'],
-        'c': ['function_definition', 'struct_declaration'],
-        'cpp': ['function_definition', 'class_declaration']
-    }
+    Returns:
+        Sorted list of (start, end) character offsets into content
+        
+    Raises:
+        SyntaxError: If content is not valid Python
+    """
+    tree = ast.parse(content)
+    line_starts = [0]
+    line_starts.extend(match.end() for match in re.finditer('\n', content))
+    
+    spans = []
+    nested = mode == 'nested'
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, _PYTHON_DEFINITIONS):
+                first_line = min([child.lineno] + [decorator.lineno for decorator in child.decorator_list])
+                last_line = child.end_lineno or child.lineno
+                start = line_starts[first_line - 1]
+                end = line_starts[last_line] - 1 if last_line < len(line_starts) else len(content)
+                spans.append((start, end))
+                if nested and isinstance(child, ast.ClassDef):
+                    stack.append(child)
+            elif not isinstance(child, ast.expr):
+                # Definitions only live in statements, so expressions are never walked
+                stack.append(child)
+    
+    spans.sort(key=lambda span: (span[0], -span[1]))
+    return _split_nested_spans(content, spans) if nested else spans
+
+_WORD_CHARACTER = re.compile(r'\w')
+_WORD_BYTE = re.compile(rb'\w')
+
+def _split_nested_spans(content: str, spans: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """Turn properly nested spans into disjoint ones.
+    
+    Every span keeps the pieces of its range that none of its children cover,
+    dropping pieces without any word characters (such as a lone closing
+    brace); spans must be sorted by start ascending, then end descending.
+    Content may be text or bytes, with spans in characters or bytes to match.
+    """
+    pieces = []
+    stack = []  # [end, position up to which the span's own text has been emitted]
+    is_text = isinstance(content, str)
+    newlines = '\r\n' if is_text else b'\r\n'
+    word_character = _WORD_CHARACTER if is_text else _WORD_BYTE
     
-    target_types = node_types.get(lang_name, [])
-    blocks = []
+    def emit(start, end):
+        text = content[start:end]
+        stripped = text.lstrip(newlines)
+        if word_character.search(stripped):
+            pieces.append((start + len(text) - len(stripped), start + len(stripped.rstrip())
+                           + len(text) - len(stripped)))
     
-    for child in root.children:
-        if child.type in target_types:
-            blocks.append(content[child.start_byte:child.end_byte])
+    for start, end in spans:
+        while stack and stack[-1][0] <= start:
+            parent_end, emitted = stack.pop()
+            emit(emitted, parent_end)
+        if stack:
+            emit(stack[-1][1], start)
+            stack[-1][1] = end
+        stack.append([end, start])
+    while stack:
+        parent_end, emitted = stack.pop()
+        emit(emitted, parent_end)
     
-    return blocks
+    pieces.sort()
+    return pieces
 
-def extract_code_blocks(file_path: str) -> List[str]:
-    """Extract key code blocks from a file based on language."""
-    if not os.path.exists(file_path):
-        return []
+# Structural fallback scanners. Each one makes a single left-to-right pass with
+# patterns that cannot backtrack, and stops at the deadline with the blocks
+# found so far, so malformed or huge files cannot stall extraction. They
+# return (spans, complete), where complete is False if the scan was cut short.
+
+_PYTHON_HEADER = re.compile(r'[ \t]*(?:@|(?:async[ \t]+)?def\b|class\b)')
+_SCAN_CHECK_INTERVAL = 1024  # Lines or tokens between deadline checks
+
+def _scan_timed_out(deadline: float, file_kind: str) -> bool:
+    """Check a scan deadline, reporting when it has passed."""
+    if time.monotonic() < deadline:
+        return False
+    print(f"Warning: {file_kind} scan exceeded {FALLBACK_SCAN_TIME_BUDGET}s, keeping blocks found so far without indexing them")
+    return True
+
+def scan_indented_blocks(content: str, deadline: float) -> Tuple[List[Tuple[int, int]], bool]:
+    """Find def/class blocks by indentation, for Python that does not parse.
+    
+    A block starts at a decorator or def/class line and runs until the next
+    non-blank line indented no deeper than its header; definitions inside an
+    open block stay part of it.
+    """
+    spans = []
+    complete = True
+    block_start = None   # Offset of the open block's first line
+    block_indent = 0
+    block_end = 0        # End of the open block's last non-blank line
+    in_decorators = False
+    offset = 0
+    for line_number, line in enumerate(content.splitlines(keepends=True)):
+        if line_number % _SCAN_CHECK_INTERVAL == 0 and _scan_timed_out(deadline, "Indentation"):
+            complete = False
+            break
+        line_start = offset
+        offset += len(line)
+        stripped = line.strip()
+        if not stripped:
+            continue
+        indent = len(line) - len(line.lstrip(' \t'))
         
-    try:
-        encoding = detect_file_encoding(file_path)
-        with open(file_path, 'r', encoding=encoding, errors='replace') as f:
-            content = f.read()
+        if block_start is not None and (indent > block_indent or in_decorators):
+            # Still inside the block (or between its decorators and its def line)
+            block_end = line_start + len(line.rstrip())
+            in_decorators = in_decorators and stripped.startswith('@')
+            continue
+        if block_start is not None:
+            spans.append((block_start, block_end))
+            block_start = None
         
-        ext = os.path.splitext(file_path)[1].lower()
+        if _PYTHON_HEADER.match(line):
+            block_start = line_start
+            block_indent = indent
+            block_end = line_start + len(line.rstrip())
+            in_decorators = stripped.startswith('@')
+    
+    if block_start is not None:
+        spans.append((block_start, block_end))
+    return spans, complete
+
+# Lexers for brace languages: comments and string literals are matched whole
+# (unterminated ones run to the end of the line or file) so braces inside them
+# are never counted
+_C_FAMILY_LEXER = re.compile(
+    r'//[^\n]*|/\*(?:[^*]|\*(?!/))*(?:\*/|\Z)'
+    r'|"(?:[^"\\\n]|\\.)*"?|\'(?:[^\'\\\n]|\\.)*\'?'
+    r'|^[ \t]*#[^\n]*'  # Preprocessor directives end a statement
+    r'|[{};]', re.MULTILINE | re.DOTALL)
+_JS_LEXER = re.compile(
+    r'//[^\n]*|/\*(?:[^*]|\*(?!/))*(?:\*/|\Z)'
+    r'|"(?:[^"\\\n]|\\.)*"?|\'(?:[^\'\\\n]|\\.)*\'?|`(?:[^`\\]|\\.)*`?'
+    r'|[{};]', re.DOTALL)
+_CSS_LEXER = re.compile(
+    r'/\*(?:[^*]|\*(?!/))*(?:\*/|\Z)'
+    r'|"(?:[^"\\\n]|\\.)*"?|\'(?:[^\'\\\n]|\\.)*\'?'
+    r'|[{};]', re.DOTALL)
+
+# Top-level blocks whose members are returned as blocks of their own
+_BRACE_CONTAINER = re.compile(r'\b(?:class|interface|enum|namespace|record)\b|@(?:media|supports|layer)\b')
+_CONTAINER_HEADER_WINDOW = 512  # Characters before a '{' searched for a container keyword
+
+def scan_brace_blocks(content: str, deadline: float, lexer=_C_FAMILY_LEXER) -> Tuple[List[Tuple[int, int]], bool]:
+    """Find brace-delimited blocks with their headers, for C-family languages and CSS.
+    
+    Every top-level block is returned from the start of its statement (after
+    the previous ';' or '}') to its closing brace. Members of top-level
+    containers such as classes, namespaces and @media rules are returned as
+    blocks of their own, and the container keeps only the text between them.
+    """
+    spans = []
+    complete = True
+    depth = 0
+    statement_start = [0, 0]  # Where the current statement began at depth 0 and 1
+    open_block = [None, None]  # Start of the open block at depth 0 and 1
+    container = False
+    for count, match in enumerate(lexer.finditer(content)):
+        if count % _SCAN_CHECK_INTERVAL == 0 and _scan_timed_out(deadline, "Brace"):
+            complete = False
+            break
+        token = match.group()
+        if token == '{':
+            if depth < 2:
+                open_block[depth] = statement_start[depth]
+                if depth == 0:
+                    header_start = max(statement_start[0], match.start() - _CONTAINER_HEADER_WINDOW)
+                    container = bool(_BRACE_CONTAINER.search(content, header_start, match.start()))
+                    statement_start[1] = match.end()
+            depth += 1
+        elif token == '}':
+            if depth == 0:
+                statement_start[0] = match.end()  # Stray closing brace
+                continue
+            depth -= 1
+            if depth == 0 or (depth == 1 and container):
+                spans.append((open_block[depth], match.end()))
+            if depth < 2:
+                statement_start[depth] = match.end()
+        elif token == ';' or token.lstrip().startswith('#'):
+            if depth < 2:
+                statement_start[depth] = match.end()
+    
+    spans.sort(key=lambda span: (span[0], -span[1]))
+    return _split_nested_spans(content, spans), complete
+
+_HTML_TOKEN = re.compile(r'<!--(?:[^-]|-(?!->))*(?:-->|\Z)|<(/?)([A-Za-z][\w:.-]*)([^>]*)(?:>|\Z)')
+_HTML_VOID_ELEMENTS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta',
+                       'param', 'source', 'track', 'wbr'}
+_HTML_RAW_TEXT_END = {'script': re.compile(r'</script\s*>', re.IGNORECASE),
+                      'style': re.compile(r'</style\s*>', re.IGNORECASE)}
+_HTML_BLOCK_ELEMENTS = {'script', 'style', 'div', 'header', 'footer', 'main', 'section', 'nav',
+                        'article', 'aside', 'form', 'table'}
+
+def scan_html_elements(content: str, deadline: float) -> Tuple[List[Tuple[int, int]], bool]:
+    """Find script, style and structural elements with a tag stack.
+    
+    Script and style bodies are skipped to their closing tag, unclosed tags are
+    popped when an enclosing element closes, and only the outermost matching
+    elements are returned so nested ones are not duplicated.
+    """
+    spans = []
+    complete = True
+    stack = []  # (tag name, start offset)
+    open_counts = {}  # Tag name -> number of open elements with that name
+    open_blocks = 0  # Elements on the stack that are themselves returned as blocks
+    position = 0
+    count = 0
+    while True:
+        count += 1
+        if count % _SCAN_CHECK_INTERVAL == 0 and _scan_timed_out(deadline, "HTML"):
+            complete = False
+            break
+        match = _HTML_TOKEN.search(content, position)
+        if not match:
+            break
+        position = match.end()
+        name = match.group(2)
+        if not name:
+            continue  # Comment
+        name = name.lower()
         
-        # Try language-specific parsers first
-        if ext == '.py':
-            try:
-                tree = ast.parse(content)
-                blocks = []
-                for node in ast.walk(tree):
-                    if isinstance(node, (ast.FunctionDef, ast.ClassDef, ast.AsyncFunctionDef)):
-                        start_line = node.lineno
-                        end_line = 0
-                        for child in ast.walk(node):
-                            if hasattr(child, 'lineno'):
-                                end_line = max(end_line, child.lineno)
-                        
-                        if end_line >= start_line:
-                            lines = content.split('\n')
-                            block_text = '\n'.join(lines[start_line-1:end_line])
-                            blocks.append(block_text)
-                return blocks if blocks else [content]
-            except SyntaxError:
-                pass  # Fall back to regex
-                
-        elif ext == '.html':
-            try:
-                soup = BeautifulSoup(content, 'html.parser')
-                blocks = []
-                # Extract scripts
-                for script in soup.find_all('script'):
-                    blocks.append(str(script))
-                # Extract styles
-                for style in soup.find_all('style'):
-                    blocks.append(str(style))
-                # Extract main elements
-                for elem in soup.find_all(['div', 'header', 'footer', 'main', 'section']):
-                    blocks.append(str(elem))
-                return blocks if blocks else [content]
-            except:
-                pass  # Fall back to regex
-                
-        elif ext == '.js':
-            try:
-                # Use esprima to parse JavaScript
-                parsed = esprima.parseScript(content)
-                blocks = []
-                for node in parsed.body:
-                    if node.type in ['FunctionDeclaration', 'ClassDeclaration']:
-                        blocks.append(content[node.range[0]:node.range[1]])
-                return blocks if blocks else [content]
-            except:
-                pass  # Fall back to regex
-                
-        # Try Tree-sitter as a backup for supported languages
-        lang_map = {'.py': 'python', '.js': 'javascript', '.java': 'java', '.c': 'c', '.cpp': 'cpp'}
-        if ext in lang_map and lang_map[ext] in PARSERS:
-            blocks = extract_with_tree_sitter(content, lang_map[ext])
-            if blocks:
-                return blocks
-        
-        # Fall back to regex for unsupported languages or if parsing failed
-        patterns = {
-            '.py': [r'(def\s+\w+\s*\([^)]*\)\s*:.*?(?=\n\s*(def|class|$)))',  # Functions
-                    r'(class\s+\w+(?:\([^)]*\))?\s*:.*?(?=\n\s*(def|class|$)))'],  # Classes
-            '.js': [r'(function\s+\w+\s*\([^)]*\)\s*{[^}]*})',  # Functions
-                    r'(class\s+\w+\s*{[^}]*})'],  # Classes
-            '.html': [r'(<script\b[^>]*>[\s\S]*?</script>)',  # Script tags
-                      r'(<style\b[^>]*>[\s\S]*?</style>)',  # Style tags
-                      r'(<[^>]+>[\s\S]*?</[^>]+>)'],  # HTML elements
-            '.css': [r'([^{}]*\{[^}]*\})',  # CSS rules
-                     r'(@media[^{]*\{[^}]*\})',  # Media queries
-                     r'(@keyframes[^{]*\{[^}]*\})'],  # Keyframes
-            '.java': [r'(public|private|protected)?\s+(static)?\s*(\w+)\s+(\w+)\s*\([^)]*\)\s*\{[^}]*\}',  # Methods
-                     r'(public|private|protected)?\s+(class|interface|enum)\s+\w+\s*(?:extends\s+\w+)?(?:implements\s+\w+(?:,\s*\w+)*)?\s*\{[^}]*\}'],  # Classes
-            '.c': [r'(\w+)\s+(\w+)\s*\([^)]*\)\s*\{[^}]*\}',  # C functions
-                  r'(struct|enum|union)\s+\w+\s*\{[^}]*\}'],  # C structs/enums
-            '.cpp': [r'(\w+)\s+(\w+)::(\w+)\s*\([^)]*\)\s*\{[^}]*\}',  # C++ methods
-                    r'(class|struct|enum|union)\s+\w+\s*(?::\s*\w+(?:,\s*\w+)*)?\s*\{[^}]*\}'],  # C++ classes
-            '.txt': [r'(.+)',]  # Plain text
-        }
+        if not match.group(1):
+            if name in _HTML_RAW_TEXT_END:
+                end = _HTML_RAW_TEXT_END[name].search(content, position)
+                position = end.end() if end else len(content)
+                if not open_blocks:
+                    spans.append((match.start(), position))
+            elif name not in _HTML_VOID_ELEMENTS and not match.group(3).rstrip().endswith('/'):
+                stack.append((name, match.start()))
+                open_counts[name] = open_counts.get(name, 0) + 1
+                open_blocks += name in _HTML_BLOCK_ELEMENTS
+            continue
         
-        file_patterns = patterns.get(ext, [r'(.+)',])
-        blocks = []
-        for pattern in file_patterns:
-            matches = re.finditer(pattern, content, re.MULTILINE | re.DOTALL)
-            blocks.extend(match.group(1).strip() for match in matches if match.group(1).strip())
+        # Closing tag: pop up to the matching open tag, if there is one
+        if not open_counts.get(name):
+            continue
+        for index in range(len(stack) - 1, -1, -1):
+            if stack[index][0] == name:
+                start = stack[index][1]
+                for tag, _ in stack[index:]:
+                    open_counts[tag] -= 1
+                    open_blocks -= tag in _HTML_BLOCK_ELEMENTS
+                del stack[index:]
+                if name in _HTML_BLOCK_ELEMENTS and not open_blocks:
+                    spans.append((start, position))
+                break
+    
+    return spans, complete
+
+FALLBACK_SCANNERS = {
+    '.py': scan_indented_blocks,
+    '.js': functools.partial(scan_brace_blocks, lexer=_JS_LEXER),
+    '.java': scan_brace_blocks,
+    '.c': scan_brace_blocks,
+    '.h': scan_brace_blocks,
+    '.cpp': scan_brace_blocks,
+    '.hpp': scan_brace_blocks,
+    '.css': functools.partial(scan_brace_blocks, lexer=_CSS_LEXER),
+    '.html': scan_html_elements,
+    '.htm': scan_html_elements,
+}
+
+def extract_code_blocks(file_path: str, content: Optional[str] = None,
+                        source: Optional[SourceFile] = None) -> List[CodeBlock]:
+    """Extract key code blocks from a file based on language.
+    
+    Args:
+        file_path: Path to the file; its extension selects the parser
+        content: The file's decoded text if the caller has already read it
+        source: The SourceFile content was decoded from, if any
+        
+    Returns:
+        CodeBlocks spanning source; their text is decoded when first read
+    """
+    return list(iter_code_blocks(file_path, content, source))
+
+def iter_code_blocks(file_path: str, content: Optional[str] = None,
+                     source: Optional[SourceFile] = None, index=None) -> Iterator[CodeBlock]:
+    """Yield the blocks extract_code_blocks() returns, creating each record on demand.
+    
+    The file is read and parsed when the first block is requested; after that
+    only the byte spans are held, so a consumer that keeps a few blocks (or
+    stops early) never holds a record for every block in the file. Files
+    read from disk are looked up in the block index (BLOCK_INDEX unless
+    another is given) and only parsed if they changed since they were indexed.
+    A fallback scan that ran out of time is not indexed, so it is retried.
+    """
+    if content is None and not os.path.exists(file_path):
+        return
+    if index is None:
+        index = BLOCK_INDEX
+        
+    tokens = None
+    try:
+        if content is None:
+            source, content = open_source_file(file_path)
+            if source is None:
+                return
+        elif source is None:
+            source = SourceFile.from_text(file_path, content)
         
-        return blocks if blocks else [content.strip()]
+        ext = os.path.splitext(file_path)[1].lower()
+        cached = index.lookup(file_path, source) if index is not None else None
+        if cached is not None:
+            spans, tokens = cached
+        else:
+            spans, complete = _find_block_spans(file_path, ext, content, source)
+            if index is not None and complete:
+                index.store(file_path, source, ext, spans)
     except Exception as e:
         print(f"Error reading file {file_path}: {str(e)}")
-        return []
+        return
+    
+    content = None  # Only the spans are needed from here on
+    for i, span in enumerate(spans):
+        block = span if isinstance(span, CodeBlock) else CodeBlock(source, span[0], span[1], ext)
+        if tokens is not None and tokens[i] >= 0:
+            block.tokens = tokens[i]
+        yield block
 
-# Find Ghidra installation if available
-def find_ghidra():
-    """Try to find Ghidra installation on the system."""
-    global GHIDRA_HEADLESS_PATH
+def _find_block_spans(file_path: str, ext: str, content: str, source: SourceFile) -> Tuple[list, bool]:
+    """Byte spans of a file's blocks, or detached CodeBlocks where the parser rewrote the text.
+    
+    Also returns whether the spans are complete; they are not when a fallback
+    scan ran out of time, and such partial results must not be indexed.
+    """
+    def byte_spans(spans):
+        return _char_spans_to_bytes(content, spans)
     
+    # Try language-specific parsers first
+    if ext == '.py':
+        try:
+            spans = extract_python_spans(content)
+            return byte_spans(spans if spans else [(0, len(content))]), True
+        except SyntaxError:
+            pass  # Fall back to regex
+            
+    elif ext == '.html':
+        try:
+            soup = bs4.BeautifulSoup(content, 'html.parser')
+            blocks = []
+            # Extract scripts
+            for script in soup.find_all('script'):
+                blocks.append(CodeBlock.detached(str(script), '.js', source))
+            # Extract styles
+            for style in soup.find_all('style'):
+                blocks.append(CodeBlock.detached(str(style), '.css', source))
+            # Extract main elements
+            for elem in soup.find_all(['div', 'header', 'footer', 'main', 'section']):
+                blocks.append(CodeBlock.detached(str(elem), ext, source))
+            return (blocks if blocks else byte_spans([(0, len(content))])), True
+        except:
+            pass  # Fall back to regex
+            
+    elif ext == '.js':
+        try:
+            # Use esprima to parse JavaScript
+            parsed = esprima.parseScript(content, {'range': True})
+            spans = [tuple(node.range) for node in parsed.body
+                     if node.type in ['FunctionDeclaration', 'ClassDeclaration']]
+            return byte_spans(spans if spans else [(0, len(content))]), True
+        except:
+            pass  # Fall back to regex
+            
+    # Try Tree-sitter as a backup for supported languages
+    lang_map = {'.py': 'python', '.js': 'javascript', '.java': 'java', '.c': 'c', '.cpp': 'cpp'}
+    if ext in lang_map and lang_map[ext] in PARSERS:
+        data = source.buffer if isinstance(source.buffer, bytes) else bytes(source.buffer)
+        spans = tree_sitter_spans(data, lang_map[ext], file_path)
+        if spans:
+            return spans, True
+    
+    # Fall back to a linear structural scan for unsupported languages or if parsing failed
+    spans = []
+    complete = True
+    scanner = FALLBACK_SCANNERS.get(ext)
+    if scanner:
+        spans, complete = scanner(content, time.monotonic() + FALLBACK_SCAN_TIME_BUDGET)
+        spans = [span for span in (_strip_span(content, start, end) for start, end in spans) if span[0] < span[1]]
+    
+    return byte_spans(spans if spans else [_strip_span(content, 0, len(content))]), complete
+
+def ghidra_search_locations() -> List[str]:
+    """Directories that may hold a Ghidra installation, most specific first."""
     # Common installation locations
     possible_locations = []
     
@@ -309,8 +2164,15 @@ def find_ghidra():
     if "GHIDRA_HOME" in os.environ:
         possible_locations.insert(0, os.environ["GHIDRA_HOME"])
     
+    return possible_locations
+
+# Find Ghidra installation if available
+def find_ghidra():
+    """Try to find Ghidra installation on the system."""
+    global GHIDRA_HEADLESS_PATH
+    
     # Look for analyzeHeadless script in each location
-    for location in possible_locations:
+    for location in ghidra_search_locations():
         if not os.path.exists(location):
             continue
         
@@ -334,14 +2196,115 @@ def find_ghidra():
                     print(f"Found Ghidra at: {GHIDRA_HEADLESS_PATH}")
                     return True
     
-    return False
-
-# Try to find Ghidra
-try:
-    find_ghidra()
-except Exception as e:
-    print(f"Warning: Error while looking for Ghidra: {e}")
+    return False
+
+def get_application_path() -> str:
+    """Directory of the executable when bundled, otherwise of this script."""
+    if getattr(sys, 'frozen', False):
+        # If we're running as a PyInstaller bundle
+        return os.path.dirname(sys.executable)
+    # If we're running as a script
+    return os.path.dirname(os.path.abspath(__file__))
+
+def _path_mtime(path: str) -> Optional[float]:
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+def _environment_fingerprint() -> Dict:
+    """Stat-only summary of everything environment discovery depends on.
+    
+    Installing or removing Ghidra changes the modification time of its
+    install root, and adding a grammar changes the grammar directory's, so
+    comparing fingerprints tells whether a cached profile is still valid
+    without listing any directory.
+    """
+    return {
+        'version': ENVIRONMENT_PROFILE_VERSION,
+        'platform': platform.system(),
+        'ghidra_home': os.environ.get("GHIDRA_HOME"),
+        'ghidra_roots': {location: _path_mtime(location) for location in ghidra_search_locations()},
+        'grammar_dir': LANGUAGE_DIR,
+        'grammar_dir_mtime': _path_mtime(LANGUAGE_DIR),
+    }
+
+def discover_environment(fingerprint: Dict) -> Dict:
+    """Probe the system for Ghidra and Tree-sitter grammars.
+    
+    The NLTK corpus is not probed here: checking for it imports NLTK, so the
+    background word list loader records it instead.
+    """
+    global GHIDRA_HEADLESS_PATH
+    GHIDRA_HEADLESS_PATH = ""
+    try:
+        find_ghidra()
+    except Exception as e:
+        print(f"Warning: Error while looking for Ghidra: {e}")
+    return {
+        'fingerprint': fingerprint,
+        'ghidra_headless_path': GHIDRA_HEADLESS_PATH,
+        'grammars': GrammarRegistry(LANGUAGE_DIR).available(),
+        'nltk_words': None,  # Unknown until the word list has been loaded once
+    }
+
+def save_environment_profile():
+    """Write the current environment profile next to tokenizer.log."""
+    if not _ENVIRONMENT_PROFILE_PATH:
+        return
+    with _ENVIRONMENT_PROFILE_LOCK:
+        temp_path = _ENVIRONMENT_PROFILE_PATH + ".tmp"
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(ENVIRONMENT_PROFILE, f, indent=2)
+            os.replace(temp_path, _ENVIRONMENT_PROFILE_PATH)
+        except OSError as e:
+            print(f"Warning: Could not save environment profile: {e}")
+
+def update_environment_profile(**changes):
+    """Record new discovery results (e.g. corpus availability) in the profile."""
+    if all(ENVIRONMENT_PROFILE.get(key) == value for key, value in changes.items()):
+        return
+    ENVIRONMENT_PROFILE.update(changes)
+    save_environment_profile()
+
+def load_environment_profile(application_path: str, refresh: bool = False) -> Dict:
+    """Load the cached environment profile, rediscovering only if it is stale.
+    
+    A valid profile costs one file read and a handful of stat calls; the
+    directory scans run on the first launch and after the environment changes.
+    
+    Args:
+        application_path: Directory holding the profile
+        refresh: Ignore the cached profile and probe again
+        
+    Returns:
+        The profile, which has also been applied to this process
+    """
+    global ENVIRONMENT_PROFILE, _ENVIRONMENT_PROFILE_PATH, GHIDRA_HEADLESS_PATH
+    _ENVIRONMENT_PROFILE_PATH = os.path.join(application_path, ENVIRONMENT_PROFILE_NAME)
+    fingerprint = _environment_fingerprint()
+    
+    profile = None
+    if not refresh:
+        try:
+            with open(_ENVIRONMENT_PROFILE_PATH) as f:
+                profile = json.load(f)
+        except (OSError, ValueError):
+            profile = None
+    
+    headless_path = profile.get('ghidra_headless_path') if isinstance(profile, dict) else None
+    if (not isinstance(profile, dict) or profile.get('fingerprint') != fingerprint
+            or (headless_path and not os.path.exists(headless_path))):
+        ENVIRONMENT_PROFILE = discover_environment(fingerprint)
+        save_environment_profile()
+    else:
+        ENVIRONMENT_PROFILE = profile
     
+    GHIDRA_HEADLESS_PATH = ENVIRONMENT_PROFILE.get('ghidra_headless_path') or ""
+    PARSERS.set_available(ENVIRONMENT_PROFILE.get('grammars') or {})
+    return ENVIRONMENT_PROFILE
+
 # Create Ghidra analysis script
 GHIDRA_SCRIPT_CONTENT = '''
 // Ghidra script to extract function information and decompile code
@@ -610,48 +2573,129 @@ def extract_keywords(prompt: str) -> List[str]:
     
     return unique_keywords
 
-def filter_relevant_blocks(blocks: List[str], keywords: List[str]) -> List[Tuple[str, float]]:
-    """Filter and rank code blocks by relevance to keywords.
+_IDENTIFIER_PATTERN = re.compile(r'\w+')
+_SUBTERM_PATTERN = re.compile(r'[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+')
+_DEFINITION_PATTERN = re.compile(r'(?:def|class|function)\s+(\w+)')
+_COMMENT_PATTERN = re.compile(r'[#/]\s([^\n]*)')
+
+@functools.lru_cache(maxsize=65536)
+def stem_term(term: str) -> str:
+    """Lightly stem a lowercase term, folding plurals onto their singular.
     
-    Args:
-        blocks: List of code blocks extracted from the file
-        keywords: List of keywords from the user's prompt
-        
-    Returns:
-        List of tuples containing (block, relevance_score)
+    A final e is dropped as well, so that cache and caches meet on one
+    stem just as match and matches do.
     """
-    if not keywords:
-        return [(block, 0.0) for block in blocks]  # No filtering if no keywords
+    if len(term) > 4 and term.endswith('ies'):
+        return term[:-3] + 'y'
+    if len(term) > 4 and term.endswith(('ches', 'shes', 'sses', 'xes', 'zes')):
+        term = term[:-2]
+    elif len(term) > 3 and term.endswith('s') and not term.endswith(('ss', 'us', 'is')):
+        term = term[:-1]
+    if len(term) > 3 and term.endswith('e') and not term.endswith('ee'):
+        term = term[:-1]
+    return term
+
+@functools.lru_cache(maxsize=65536)
+def identifier_terms(identifier: str) -> Tuple[str, ...]:
+    """Normalized sub-terms of an identifier, split on underscores, digits and case changes.
     
-    scored_blocks = []
+    MAX_TOKENS_PER_STEP gives ('max', 'token', 'per', 'step'), and
+    parseHTMLString gives ('parse', 'html', 'string').
+    """
+    if identifier.isascii():
+        parts = _SUBTERM_PATTERN.findall(identifier)
+    else:
+        parts = [part for part in re.split(r'[_\d]+', identifier) if part]
+    return tuple(stem_term(part.lower()) for part in parts)
+
+def block_terms(text: str) -> Dict[str, int]:
+    """Term frequencies of a block's identifier sub-terms, as identifier_terms() splits them."""
+    terms = {}
+    for identifier in _IDENTIFIER_PATTERN.findall(text):
+        for term in identifier_terms(identifier):
+            terms[term] = terms.get(term, 0) + 1
+    return terms
+
+class BlockTerms:
+    """A block's identifier sub-terms, counted once so scoring needs only lookups.
     
-    for block in blocks:
-        # Calculate relevance score based on keyword presence
-        score = 0.0
-        block_lower = block.lower()
+    Besides the term counts this keeps which terms name a definition (after
+    def, class or function) and which appear after a comment mark, for the
+    relevance bonuses, and the block's length in words, for normalization.
+    """
+    
+    __slots__ = ('counts', 'definitions', 'comments', 'words')
+    
+    def __init__(self, counts: Dict[str, int], definitions: frozenset, comments: frozenset, words: int):
+        self.counts = counts
+        self.definitions = definitions
+        self.comments = comments
+        self.words = words
+    
+    @classmethod
+    def from_text(cls, text: str) -> 'BlockTerms':
+        definitions = frozenset(term for name in _DEFINITION_PATTERN.findall(text) for term in identifier_terms(name))
+        comments = frozenset(term for comment in _COMMENT_PATTERN.findall(text) for term in block_terms(comment))
+        return cls(block_terms(text), definitions, comments, len(text.split()))
+    
+    def score(self, keywords: List[str]) -> float:
+        """Relevance to the prompt's keywords, normalized by the block's length.
         
+        A keyword matches as many times as its rarest sub-term occurs, so
+        "token" matches MAX_TOKENS_PER_STEP and "max_tokens" matches
+        maxTokens. Each matching keyword scores 2 per match plus 1, 5 more
+        if it names a definition and 3 more if it appears in a comment.
+        """
+        score = 0.0
+        counts = self.counts
         for keyword in keywords:
-            # Check exact matches (case insensitive)
-            matches = re.findall(r'\b' + re.escape(keyword.lower()) + r'\b', block_lower)
-            score += len(matches) * 2  # Exact matches are weighted higher
-            
-            # Check partial matches (for variable/function names)
-            if keyword.lower() in block_lower:
-                score += 1
-                
-            # Give higher score for keywords in function/class definitions or comments
-            if re.search(r'(def|class|function)\s+\w*' + re.escape(keyword.lower()) + r'\w*', block_lower):
+            parts = identifier_terms(keyword)
+            if not parts:
+                continue
+            matches = min(counts.get(part, 0) for part in parts)
+            if not matches:
+                continue
+            score += matches * 2 + 1  # Exact matches are weighted higher
+            if all(part in self.definitions for part in parts):
                 score += 5
-                
-            if re.search(r'[#//]\s.*' + re.escape(keyword.lower()), block_lower):
+            if all(part in self.comments for part in parts):
                 score += 3  # Keywords in comments
         
         # Normalize score by block length to not overly favor long blocks
-        normalized_score = score / (len(block.split()) + 1)
+        return score / (self.words + 1)
+
+def block_term_map(block) -> BlockTerms:
+    """BlockTerms of a block, computed once per CodeBlock."""
+    return BlockTerms.from_text(block) if isinstance(block, str) else block.terms
+
+def score_block(text: str, keywords: List[str]) -> float:
+    """Relevance of a block's text to the prompt's keywords, normalized by its length."""
+    return BlockTerms.from_text(text).score(keywords)
+
+def iter_scored_blocks(blocks: Iterable[CodeBlock], keywords: List[str]) -> Iterator[Tuple[CodeBlock, float]]:
+    """Yield (block, relevance_score) for every block; CodeBlocks also keep their score."""
+    for block in blocks:
+        score = block_term_map(block).score(keywords)
+        if not isinstance(block, str):
+            block.score = score
+        yield block, score
+
+def filter_relevant_blocks(blocks: List[CodeBlock], keywords: List[str]) -> List[Tuple[CodeBlock, float]]:
+    """Filter and rank code blocks by relevance to keywords.
+    
+    Args:
+        blocks: List of code blocks (CodeBlocks or strings) extracted from the file
+        keywords: List of keywords from the user's prompt
         
-        # Only include blocks with some relevance
-        if normalized_score > 0:
-            scored_blocks.append((block, normalized_score))
+    Returns:
+        List of tuples containing (block, relevance_score); CodeBlocks also
+        keep their score
+    """
+    if not keywords:
+        return [(block, 0.0) for block in blocks]  # No filtering if no keywords
+    
+    # Only include blocks with some relevance
+    scored_blocks = [(block, score) for block, score in iter_scored_blocks(blocks, keywords) if score > 0]
     
     # Sort blocks by relevance score (descending)
     scored_blocks.sort(key=lambda x: x[1], reverse=True)
@@ -662,23 +2706,620 @@ def filter_relevant_blocks(blocks: List[str], keywords: List[str]) -> List[Tuple
         
     return scored_blocks
 
-def generate_steps(prompt: str, code_blocks: List[str] = [], relevance_info: List[float] = None) -> List[str]:
+def select_relevant_blocks(blocks: Iterable[CodeBlock], keywords: List[str], limit: int,
+                           counts: Optional[Dict[str, int]] = None) -> List[Tuple[CodeBlock, float]]:
+    """The first `limit` entries of filter_relevant_blocks(), from a stream of blocks.
+    
+    Only a heap of the best `limit` blocks is kept while the stream is
+    consumed (plus, until something matches, the first `limit` blocks in
+    case nothing does), so memory does not grow with the file.
+    
+    Args:
+        blocks: Code blocks in file order; may be a generator
+        keywords: List of keywords from the user's prompt
+        limit: Number of blocks to keep
+        counts: Optional dict that receives the number of 'blocks' seen and
+            how many were 'relevant'
+        
+    Returns:
+        List of (block, relevance_score) tuples, best first
+    """
+    if limit <= 0:
+        return []
+    if not keywords:
+        kept = [(block, 0.0) for block in itertools.islice(blocks, limit)]
+        if counts is not None:
+            counts.update(blocks=len(kept), relevant=0)
+        return kept
+    
+    heap = []      # (score, -index, block); the root is the block to drop next
+    unmatched = []  # First blocks in file order, used if no block matches
+    total = relevant = 0
+    for index, (block, score) in enumerate(iter_scored_blocks(blocks, keywords)):
+        total += 1
+        if score > 0:
+            relevant += 1
+            item = (score, -index, block)
+            if len(heap) < limit:
+                heapq.heappush(heap, item)
+                unmatched = []
+            elif item[:2] > heap[0][:2]:
+                heapq.heapreplace(heap, item)
+        elif not heap and len(unmatched) < limit:
+            unmatched.append(block)
+    
+    if counts is not None:
+        counts.update(blocks=total, relevant=relevant)
+    if not heap:
+        return [(block, 0.0) for block in unmatched]
+    heap.sort(key=lambda item: item[:2], reverse=True)
+    return [(block, score) for score, _, block in heap]
+
+_SHINGLE_TOKEN = re.compile(r'\w+|[^\w\s]')
+_EMPTY_BIN = 1 << 64  # Above every hash(), so it is never a bin's minimum
+
+def block_shingles(text: str) -> set:
+    """Hashes of a block's shingles: every run of DEDUP_SHINGLE_TOKENS consecutive tokens."""
+    tokens = _SHINGLE_TOKEN.findall(text)
+    if len(tokens) >= DEDUP_SHINGLE_TOKENS:
+        return set(map(hash, zip(*(tokens[i:] for i in range(DEDUP_SHINGLE_TOKENS)))))
+    return {hash(tuple(tokens))}
+
+def block_sketch(text: str, shingles: Optional[set] = None) -> Tuple[int, ...]:
+    """One-permutation MinHash sketch of a block's token shingles.
+    
+    Each shingle hash from block_shingles() (passed in if already computed)
+    falls into one of DEDUP_SKETCH_BINS bins by its low bits; the sketch
+    holds the smallest hash of each bin. The share of bins two sketches agree
+    on estimates the Jaccard similarity of their shingle sets, and a block
+    whose shingles include another's has a minimum no larger in every bin.
+    """
+    if shingles is None:
+        shingles = block_shingles(text)
+    bin_mask = DEDUP_SKETCH_BINS - 1
+    minima = {shingle & bin_mask: shingle for shingle in sorted(shingles, reverse=True)}  # The smallest is written last
+    return tuple(minima.get(i, _EMPTY_BIN) for i in range(DEDUP_SKETCH_BINS))
+
+def sketch_similarity(a: Tuple[int, ...], b: Tuple[int, ...]) -> float:
+    """Estimated Jaccard similarity of the shingle sets two block_sketch() sketches were taken from."""
+    equal = list(itertools.compress(a, map(operator.eq, a, b)))
+    both_empty = equal.count(_EMPTY_BIN)
+    filled = len(a) - both_empty
+    return (len(equal) - both_empty) / filled if filled else 1.0
+
+def _sketch_covers(outer: Tuple[int, ...], inner: Tuple[int, ...]) -> bool:
+    """Whether outer's shingles may include all of inner's, judging by their sketches."""
+    return all(map(operator.le, outer, inner))
+
+def iter_unique_blocks(scored_blocks: Iterable[Tuple[CodeBlock, float]],
+                       stats: Optional[Dict[str, int]] = None) -> Iterator[Tuple[CodeBlock, float]]:
+    """Yield scored blocks in order, skipping those that repeat a block already yielded.
+    
+    A block is skipped as a duplicate when its block_sketch() is estimated at
+    least DEDUP_SIMILARITY similar to a kept block's (generated code, vendored
+    copies, repeated templates), and as nested when it lies within or around
+    a kept block of the same file (such as the nested divs of an HTML page).
+    Similar sketches are found by LSH: the sketch is cut into DEDUP_LSH_BANDS
+    bands and a block is only compared with kept blocks that share a band
+    exactly, at most DEDUP_BUCKET_MAX of them per band. Nesting is looked up the same way: kept span blocks are kept
+    sorted, and a detached block (text a parser rewrote, so it has no span)
+    can only lie within the kept blocks holding the shingle of it that the
+    fewest kept blocks hold, or around kept blocks whose such shingle it
+    holds; only those are compared.
+    The work therefore grows about linearly with the blocks' total length.
+    Blocks arrive in priority order, so the most relevant copy is the one
+    kept and the budget the others would have taken goes to unique code.
+    
+    Args:
+        scored_blocks: (block, relevance_score) pairs in priority order; may be
+            a generator, which is consumed lazily
+        stats: Optional dict whose 'duplicate' and 'nested' counts are
+            increased for each block skipped
+    """
+    rows = DEDUP_SKETCH_BINS // DEDUP_LSH_BANDS
+    empty_band = (_EMPTY_BIN,) * rows
+    kept = []      # Sketch of each kept block
+    buckets = {}   # (band, its minima) -> indexes into kept
+    spans = {}     # File path -> ([starts], [ends]) of kept span blocks; kept spans never nest, so both are sorted
+    detached = {}  # File path -> ({shingle: kept indexes}, {anchor shingle: kept indexes}) of kept detached blocks
+    texts = {}     # Kept index -> text of a kept detached block
+    for block, score in scored_blocks:
+        text = block_text(block)
+        shingles = block_shingles(text)
+        sketch = block_sketch(text, shingles)
+        bands = [(band, sketch[band * rows:(band + 1) * rows]) for band in range(DEDUP_LSH_BANDS)]
+        bands = [key for key in bands if key[1] != empty_band]  # Blocks too short to fill a band say nothing by it
+        candidates = set()
+        for key in bands:
+            candidates.update(buckets.get(key, ()))
+        if any(sketch_similarity(sketch, kept[i]) >= DEDUP_SIMILARITY for i in candidates):
+            if stats is not None:
+                stats['duplicate'] = stats.get('duplicate', 0) + 1
+            continue
+        
+        path = block.path if isinstance(block, CodeBlock) else None
+        if path is not None:
+            if block.is_detached:
+                holders, anchors = detached.setdefault(path, ({}, {}))
+                # A kept block holding this one holds every shingle of it, the least held one included
+                anchor = min(shingles, key=lambda shingle: len(holders.get(shingle, ())))
+                nested = any(_sketch_covers(kept[i], sketch) and text in texts[i] for i in holders.get(anchor, ()))
+                if not nested:
+                    inner = set()
+                    for shingle in shingles:
+                        inner.update(anchors.get(shingle, ()))
+                    nested = any(_sketch_covers(sketch, kept[i]) and texts[i] in text for i in inner)
+            else:
+                starts, ends = spans.setdefault(path, ([], []))
+                i = bisect.bisect_right(starts, block.start)
+                j = bisect.bisect_left(starts, block.start)
+                nested = (i and ends[i - 1] >= block.end) or (j < len(starts) and ends[j] <= block.end)
+            if nested:
+                if stats is not None:
+                    stats['nested'] = stats.get('nested', 0) + 1
+                continue
+            if block.is_detached:
+                for shingle in shingles:
+                    holders.setdefault(shingle, []).append(len(kept))
+                anchors.setdefault(anchor, []).append(len(kept))
+                texts[len(kept)] = text
+            else:
+                starts.insert(i, block.start)
+                ends.insert(i, block.end)
+        
+        for key in bands:
+            bucket = buckets.setdefault(key, [])
+            if len(bucket) < DEDUP_BUCKET_MAX:
+                bucket.append(len(kept))
+        kept.append(sketch)
+        yield block, score
+
+class BM25Index:
+    """Inverted index from terms to code blocks, ranked with BM25.
+    
+    Files are added and removed as units, so a repository's index is built
+    once and then only the files that changed are reindexed. Each term's
+    postings are parallel arrays of block ids and term frequencies; blocks
+    of removed files are only marked dead and dropped from the postings
+    when dead blocks outnumber live ones.
+    """
+    
+    def __init__(self, k1: float = BM25_K1, b: float = BM25_B):
+        self.k1 = k1
+        self.b = b
+        self._postings = {}   # term -> (array of block ids, array of term frequencies)
+        self._df = {}         # term -> number of live blocks containing it
+        self._files = {}      # path -> (stamp, extension, first block id, block count, {term: blocks containing it})
+        self._paths = []      # Block's file path, by block id
+        self._starts = array('q')
+        self._ends = array('q')
+        self._lengths = array('i')
+        self._tokens = array('i')
+        self._texts = {}      # Block id -> (detached text, language)
+        self._alive = bytearray()
+        self._live = 0
+        self._total_length = 0
+    
+    def __len__(self) -> int:
+        return self._live
+    
+    def __contains__(self, file_path: str) -> bool:
+        return file_path in self._files
+    
+    def paths(self) -> List[str]:
+        """Paths of the indexed files."""
+        return list(self._files)
+    
+    def stamp(self, file_path: str):
+        """The stamp a file was indexed with, or None."""
+        record = self._files.get(file_path)
+        return record[0] if record else None
+    
+    def add_file(self, file_path: str, stamp, ext: str,
+                 blocks: List[Tuple[int, int, Optional[str], Optional[str], Optional[int], Dict[str, int]]]):
+        """Index a file's blocks, replacing any earlier version of the file.
+        
+        Args:
+            file_path: Path of the file
+            stamp: Anything that changes with the file, e.g. (size, mtime_ns)
+            ext: File extension, the language of blocks that are spans of the file
+            blocks: (start, end, detached text, language, tokens, term frequencies) per block, in file order
+        """
+        self.remove_file(file_path)
+        first = len(self._paths)
+        file_terms = {}
+        for offset, (start, end, text, language, tokens, terms) in enumerate(blocks):
+            block_id = first + offset
+            length = 0
+            for term, frequency in terms.items():
+                posting = self._postings.get(term)
+                if posting is None:
+                    posting = self._postings[term] = (array('i'), array('i'))
+                posting[0].append(block_id)
+                posting[1].append(frequency)
+                self._df[term] = self._df.get(term, 0) + 1
+                file_terms[term] = file_terms.get(term, 0) + 1
+                length += frequency
+            self._paths.append(file_path)
+            self._starts.append(start)
+            self._ends.append(end)
+            self._lengths.append(length)
+            self._tokens.append(-1 if tokens is None else tokens)
+            if text is not None:
+                self._texts[block_id] = (text, language)
+            self._alive.append(1)
+            self._total_length += length
+        self._live += len(blocks)
+        self._files[file_path] = (stamp, ext, first, len(blocks), file_terms)
+    
+    def remove_file(self, file_path: str):
+        """Drop a file's blocks from the index, if it is indexed."""
+        record = self._files.pop(file_path, None)
+        if record is None:
+            return
+        _, _, first, count, file_terms = record
+        for term, blocks in file_terms.items():
+            self._df[term] -= blocks
+        for block_id in range(first, first + count):
+            self._alive[block_id] = 0
+            self._total_length -= self._lengths[block_id]
+            self._texts.pop(block_id, None)
+        self._live -= count
+        if len(self._paths) - self._live > max(self._live, 1024):
+            self._compact()
+    
+    def top_k(self, keywords: List[str], limit: int) -> List[Tuple[int, float]]:
+        """The `limit` best (block id, score) pairs for the keywords, best first.
+        
+        Ties keep the order in which blocks were indexed.
+        """
+        if not self._live or limit <= 0:
+            return []
+        k1, b = self.k1, self.b
+        average_length = self._total_length / self._live or 1.0
+        lengths = self._lengths
+        alive = self._alive
+        scores = {}
+        for term in {term for keyword in keywords for term in identifier_terms(keyword)}:
+            posting = self._postings.get(term)
+            df = self._df.get(term, 0)
+            if posting is None or not df:
+                continue
+            idf = math.log(1 + (self._live - df + 0.5) / (df + 0.5))
+            for block_id, frequency in zip(*posting):
+                if alive[block_id]:
+                    norm = k1 * (1 - b + b * lengths[block_id] / average_length)
+                    scores[block_id] = scores.get(block_id, 0.0) + idf * frequency * (k1 + 1) / (frequency + norm)
+        return heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], -item[0]))
+    
+    def count_matches(self, keywords: List[str]) -> int:
+        """Number of live blocks containing any of the keywords."""
+        matched = set()
+        for term in {term for keyword in keywords for term in identifier_terms(keyword)}:
+            posting = self._postings.get(term)
+            if posting is not None:
+                matched.update(block_id for block_id in posting[0] if self._alive[block_id])
+        return len(matched)
+    
+    def file_blocks(self, file_path: str) -> range:
+        """Block ids of an indexed file, in file order."""
+        record = self._files.get(file_path)
+        return range(record[2], record[2] + record[3]) if record else range(0)
+    
+    def block(self, block_id: int, sources: Optional[Dict[str, SourceFile]] = None) -> CodeBlock:
+        """A CodeBlock for an indexed block, reading its text from the file when needed.
+        
+        sources lets blocks of one file share a SourceFile.
+        """
+        path = self._paths[block_id]
+        source = sources.get(path) if sources is not None else None
+        if source is None:
+            source = SourceFile.deferred(path)
+            if sources is not None:
+                sources[path] = source
+        text, language = self._texts.get(block_id, (None, self._files[path][1]))
+        block = CodeBlock(source, self._starts[block_id], self._ends[block_id], language, text)
+        if self._tokens[block_id] >= 0:
+            block.tokens = self._tokens[block_id]
+        return block
+    
+    def _compact(self):
+        """Renumber the live blocks and drop dead ones from the postings."""
+        new_ids = array('i', [-1]) * len(self._paths)
+        live_ids = [block_id for block_id in range(len(self._paths)) if self._alive[block_id]]
+        for new_id, block_id in enumerate(live_ids):
+            new_ids[block_id] = new_id
+        for term, (ids, frequencies) in list(self._postings.items()):
+            kept = [(new_ids[block_id], frequency) for block_id, frequency in zip(ids, frequencies) if new_ids[block_id] >= 0]
+            if kept:
+                self._postings[term] = (array('i', (block_id for block_id, _ in kept)),
+                                        array('i', (frequency for _, frequency in kept)))
+            else:
+                del self._postings[term]
+                self._df.pop(term, None)
+        self._paths = [self._paths[block_id] for block_id in live_ids]
+        self._starts = array('q', (self._starts[block_id] for block_id in live_ids))
+        self._ends = array('q', (self._ends[block_id] for block_id in live_ids))
+        self._lengths = array('i', (self._lengths[block_id] for block_id in live_ids))
+        self._tokens = array('i', (self._tokens[block_id] for block_id in live_ids))
+        self._texts = {new_ids[block_id]: text for block_id, text in self._texts.items()}
+        self._alive = bytearray(b'\x01') * len(live_ids)
+        for path, (stamp, ext, first, count, file_terms) in self._files.items():
+            self._files[path] = (stamp, ext, new_ids[first] if count else 0, count, file_terms)
+
+_REPOSITORY_INDEXES: Dict[str, BM25Index] = {}  # Repository root -> its BM25Index, kept for the session
+
+# Repository mode: every source file under a directory, extracted in parallel
+
+def _translate_gitignore_glob(pattern: str) -> str:
+    """Regex for a .gitignore glob; '*' and '?' stop at '/', '**' crosses directories."""
+    parts = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            parts.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i):
+            parts.append('.*')
+            i += 2
+        elif pattern[i] == '*':
+            parts.append('[^/]*')
+            i += 1
+        elif pattern[i] == '?':
+            parts.append('[^/]')
+            i += 1
+        elif pattern[i] == '[':
+            close = pattern.find(']', i + 2 if pattern[i + 1:i + 2] in ('!', '^') else i + 1)
+            if close == -1:
+                parts.append(re.escape('['))
+                i += 1
+                continue
+            body = pattern[i + 1:close]
+            if body.startswith('!'):
+                body = '^' + body[1:]
+            parts.append('[' + body.replace('\\', '\\\\') + ']')
+            i = close + 1
+        elif pattern[i] == '\\' and i + 1 < len(pattern):
+            parts.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            parts.append(re.escape(pattern[i]))
+            i += 1
+    return ''.join(parts)
+
+def parse_gitignore(text: str) -> List[Tuple[re.Pattern, bool, bool]]:
+    """Compile .gitignore lines into (regex, negated, directories_only) rules.
+    
+    Each regex matches a path relative to the .gitignore's directory; patterns
+    without an inner '/' match at any depth.
+    """
+    rules = []
+    for line in text.splitlines():
+        if not line.strip() or line.startswith('#'):
+            continue
+        line = re.sub(r'(?<!\\) +$', '', line)  # Trailing spaces unless escaped
+        negated = line.startswith('!')
+        if negated:
+            line = line[1:]
+        elif line[:2] in ('\\#', '\\!'):
+            line = line[1:]
+        directories_only = line.endswith('/')
+        line = line.rstrip('/')
+        if not line:
+            continue
+        anchored = '/' in line
+        body = _translate_gitignore_glob(line.lstrip('/'))
+        rules.append((re.compile(('' if anchored else '(?:.*/)?') + body + r'\Z'), negated, directories_only))
+    return rules
+
+def _git_listed_files(root: str) -> Optional[List[str]]:
+    """Files git would track under root (tracked plus untracked, not ignored), or None outside a work tree."""
+    try:
+        result = subprocess.run(['git', '-C', root, 'ls-files', '-z', '--cached', '--others', '--exclude-standard'],
+                                capture_output=True, timeout=60,
+                                creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0))
+    except (OSError, subprocess.SubprocessError):
+        return None
+    if result.returncode != 0:
+        return None
+    return [path for path in result.stdout.decode('utf-8', errors='surrogateescape').split('\0') if path]
+
+def iter_repository_files(root: str, extensions=None) -> Iterator[str]:
+    """Yield the source files under a directory that .gitignore does not exclude, in path order.
+    
+    Inside a git work tree git itself lists the files, so every ignore source
+    git honors applies; elsewhere each directory's .gitignore is applied while
+    walking, and ignored directories are not descended into.
+    
+    Args:
+        root: Directory to walk
+        extensions: File extensions to include; defaults to REPOSITORY_EXTENSIONS
+    """
+    extensions = REPOSITORY_EXTENSIONS if extensions is None else extensions
+    listed = _git_listed_files(root)
+    if listed is not None:
+        for relative in sorted(listed):
+            path = os.path.join(root, relative)
+            if os.path.splitext(relative)[1].lower() in extensions and os.path.isfile(path):
+                yield path
+        return
+    
+    rules_by_dir = {}  # Directory -> rules in effect there: (base, regex, negated, directories_only)
+    for directory, subdirs, files in os.walk(root):
+        relative_dir = os.path.relpath(directory, root).replace(os.sep, '/')
+        relative_dir = '' if relative_dir == '.' else relative_dir
+        rules = list(rules_by_dir.pop(directory, []))
+        if '.gitignore' in files:
+            try:
+                with open(os.path.join(directory, '.gitignore'), encoding='utf-8', errors='replace') as f:
+                    rules.extend((relative_dir, *rule) for rule in parse_gitignore(f.read()))
+            except OSError:
+                pass
+        
+        def ignored(name, is_dir):
+            path = f"{relative_dir}/{name}" if relative_dir else name
+            result = False
+            for base, regex, negated, directories_only in rules:
+                if directories_only and not is_dir:
+                    continue
+                if base and not path.startswith(base + '/'):
+                    continue
+                if regex.match(path[len(base) + 1:] if base else path):
+                    result = not negated
+            return result
+        
+        subdirs[:] = sorted(name for name in subdirs if name != '.git' and not ignored(name, True))
+        for name in subdirs:
+            rules_by_dir[os.path.join(directory, name)] = rules
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() in extensions and not ignored(name, False):
+                yield os.path.join(directory, name)
+
+def _init_extract_worker():
+    """Process-pool initializer: only the parent process writes to the block index."""
+    global BLOCK_INDEX
+    BLOCK_INDEX = None
+
+def _extract_indexed_blocks(file_path: str, entry: Optional[Dict]):
+    """Process-pool worker: every block of a file with its term frequencies, for BM25Index.add_file().
+    
+    Returns:
+        (extension, [(start, end, detached text, language, tokens, terms)], index entry for the parent to store or None)
+    """
+    index = _PrefetchedIndex(entry)
+    try:
+        blocks = [(block.start, block.end, block._text, block.language, block.tokens, block.terms.counts)
+                  for block in iter_code_blocks(file_path, index=index)]
+    except Exception as e:
+        print(f"Error extracting {file_path}: {e}")
+        return '', [], None
+    return os.path.splitext(file_path)[1].lower(), blocks, index.stored
+
+def rank_repository_blocks(root: str, files: List[str], keywords: List[str], limit: int = RELEVANT_BLOCKS_KEPT,
+                           processes: Optional[int] = None, counts: Optional[Dict[str, int]] = None,
+                           progress=None) -> List[Tuple[CodeBlock, float]]:
+    """Rank the blocks of a repository's files by BM25 relevance to the keywords.
+    
+    The repository's BM25Index is kept for the session: files are only
+    extracted (in a process pool, through the block index) when they are new
+    or their size or mtime changed, and files no longer listed are dropped.
+    If no block matches, the first `limit` blocks in file order are returned
+    with a score of 0.
+    
+    Args:
+        root: Repository directory the files were listed from
+        files: Files in priority order, e.g. from iter_repository_files()
+        keywords: List of keywords from the user's prompt
+        limit: Number of blocks to keep
+        processes: Worker processes; defaults to EXTRACT_PROCESSES
+        counts: Optional dict that receives 'files', 'blocks' and 'relevant' totals
+        progress: Optional callback taking (files extracted, files to extract)
+        
+    Returns:
+        List of (block, relevance_score) tuples, best first
+    """
+    index = _REPOSITORY_INDEXES.setdefault(os.path.abspath(root), BM25Index())
+    listed = set(files)
+    for path in [path for path in index.paths() if path not in listed]:
+        index.remove_file(path)
+    
+    stale = []
+    stamps = {}
+    for path in files:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            index.remove_file(path)
+            continue
+        stamps[path] = (stat.st_size, stat.st_mtime_ns)
+        if index.stamp(path) != stamps[path]:
+            stale.append(path)
+    
+    block_index = BLOCK_INDEX
+    stored = []  # (path, entry) pairs to write to the block index
+    if stale:
+        entries = (block_index.get_entry(path) if block_index is not None else None for path in stale)
+        processes = min(processes or EXTRACT_PROCESSES, len(stale))
+        
+        def add(results):
+            for done, (path, (ext, blocks, entry)) in enumerate(zip(stale, results), 1):
+                index.add_file(path, stamps[path], ext, blocks)
+                if entry is not None:
+                    stored.append((path, entry))
+                if progress:
+                    progress(done, len(stale))
+        
+        if processes <= 1:
+            add(map(_extract_indexed_blocks, stale, entries))
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=processes, initializer=_init_extract_worker) as executor:
+                add(executor.map(_extract_indexed_blocks, stale, entries,
+                                 chunksize=max(1, len(stale) // (processes * 8))))
+    if block_index is not None:
+        try:
+            block_index.put_entries(stored)
+            # Files served from memory are still in use, so keep their entries from being evicted
+            stored_paths = {path for path, _ in stored}
+            block_index.touch(path for path in files if path not in stored_paths)
+        except Exception as e:
+            print(f"Warning: Could not update block index: {e}")
+    
+    ranked = index.top_k(keywords, limit) if keywords else []
+    if counts is not None:
+        counts.update(files=len(files), blocks=len(index), relevant=index.count_matches(keywords) if ranked else 0)
+    sources = {}
+    if not ranked:
+        # Nothing matched: blocks in file order, as select_relevant_blocks() falls back to
+        first_ids = itertools.chain.from_iterable(index.file_blocks(path) for path in files)
+        ranked = [(block_id, 0.0) for block_id in itertools.islice(first_ids, limit)]
+    result = []
+    for block_id, score in ranked:
+        block = index.block(block_id, sources)
+        block.score = score
+        result.append((block, score))
+    return result
+
+def generate_steps(prompt: str, code_blocks: List[CodeBlock] = [], relevance_info: List[float] = None,
+                   approximate: Optional[bool] = None, budgets: Optional[List[int]] = None):
     """Generate optimized steps from prompt and code blocks.
     
+    Blocks are optimized and split lazily, in batches, and only until the
+    token limit is reached, so the text of blocks that cannot fit is never
+    materialized.
+    
     Args:
         prompt: The user's input prompt
-        code_blocks: List of extracted code blocks
+        code_blocks: Extracted code blocks (CodeBlocks or strings) in priority order
         relevance_info: Optional list of relevance scores for each block
+        approximate: Estimate token counts away from the budget edge; by default
+            this is decided from the input size
+        budgets: Optional list of token limits to produce steps for in one
+            pass, instead of MAX_TOKEN_LIMIT (see steps_for_budgets())
         
     Returns:
-        List of formatted steps to display to the user
+        List of formatted steps to display to the user, or with budgets a
+        dict from each budget to its list of steps
     """
+    if approximate is None:
+        approximate = should_estimate_tokens(prompt, code_blocks)
+    relevance_info = relevance_info or []
+    scored_blocks = [(block, relevance_info[i] if i < len(relevance_info) else 0.0)
+                     for i, block in enumerate(code_blocks)]
+    
+    if budgets is not None:
+        variants = steps_for_budgets(build_prompt_steps(prompt, approximate), scored_blocks, budgets, approximate)
+        return {budget: steps if steps else ["No content to process"] for budget, steps in variants.items()}
+    
+    steps = list(iter_steps(build_prompt_steps(prompt, approximate), scored_blocks, approximate))
+    
+    return steps if steps else ["No content to process"]
+
+def build_prompt_steps(prompt: str, approximate: bool = False) -> List[str]:
+    """The keyword step and the optimized prompt, split into steps; these lead every output."""
     optimized_prompt = optimize_text(prompt, is_code=False)
-    prompt_tokens = tokenize(optimized_prompt)
     
     steps = []
-    current_step = []
-    current_tokens = 0
     
     # Add an initial step with the extracted keywords if available
     keywords = extract_keywords(prompt)
@@ -686,79 +3327,298 @@ def generate_steps(prompt: str, code_blocks: List[str] = [], relevance_info: Lis
         keyword_step = "Extracted Keywords: " + ", ".join(keywords)
         steps.append(keyword_step)
     
-    # Handle prompt
-    if prompt_tokens > MAX_TOKENS_PER_STEP:
-        words = optimized_prompt.split()
-        for word in words:
-            word_tokens = tokenize(word + " ")
-            if current_tokens + word_tokens > MAX_TOKENS_PER_STEP:
-                if current_step:
-                    steps.append(" ".join(current_step))
-                    current_step = []
-                    current_tokens = 0
-                current_step.append(word)
-                current_tokens = word_tokens
-            else:
-                current_step.append(word)
-                current_tokens += word_tokens
+    # Handle prompt, cutting oversized prompts at word boundaries
+    if approximate:
+        steps.extend(split_text_by_estimate(optimized_prompt, MAX_TOKENS_PER_STEP, '.txt', separators=(" ",)))
     else:
-        steps.append(optimized_prompt)
-    
-    if current_step and len(current_step) > 0 and " ".join(current_step) not in steps:
-        steps.append(" ".join(current_step))
-    
-    # Handle code blocks with relevance information
-    for i, block in enumerate(code_blocks):
-        file_type = '.py' if "def " in block or "class " in block else \
-                   '.js' if "function " in block or "var " in block else \
-                   '.html' if "<" in block and ">" in block else \
-                   '.css' if "{" in block and ":" in block else '.txt'
-                   
-        optimized_block = optimize_text(block, is_code=True, file_type=file_type)
-        block_tokens = tokenize(optimized_block)
-        
-        # Add relevance score comment if available
-        if relevance_info and i < len(relevance_info) and relevance_info[i] > 0:
-            relevance_header = f"\n# Relevance Score: {relevance_info[i]:.2f} - This code matches your keywords\n"
-            optimized_block = relevance_header + optimized_block
-        
-        if block_tokens > MAX_TOKENS_PER_STEP:
-            lines = optimized_block.split('\n')
-            sub_block = []
-            sub_tokens = 0
-            for line in lines:
-                line_tokens = tokenize(line)
-                if sub_tokens + line_tokens > MAX_TOKENS_PER_STEP:
-                    if sub_block:
-                        steps.append("\n".join(sub_block))
-                        sub_block = [line]
-                        sub_tokens = line_tokens
-                else:
-                    sub_block.append(line)
-                    sub_tokens += line_tokens
-            if sub_block:
-                steps.append("\n".join(sub_block))
+        steps.extend(split_text_by_tokens(optimized_prompt, MAX_TOKENS_PER_STEP, separators=(" ",)))
+    return steps
+
+def iter_steps(prompt_steps: List[str], scored_blocks: Iterable[Tuple[CodeBlock, float]],
+               approximate: bool = False, limit: int = MAX_TOKEN_LIMIT,
+               stats: Optional[Dict[Optional[str], Dict[str, int]]] = None) -> Iterator[str]:
+    """Yield the steps that fit the token limit as they are admitted.
+    
+    Args:
+        prompt_steps: Steps from build_prompt_steps()
+        scored_blocks: (block, relevance_score) pairs in priority order; may be
+            a generator, which is only advanced until the limit is reached.
+            Blocks repeating an earlier one are skipped (iter_unique_blocks()),
+            then a list of ranked blocks is narrowed to the most relevant set
+            that fits, by select_blocks_for_budget(), ending with
+            TRUNCATION_NOTE if any were left out
+        approximate: Estimate token counts away from the budget edge
+        limit: Maximum total number of tokens
+        stats: Optional dict that receives the strip_code() byte totals of
+            the blocks optimized, by file type (see optimize_code_blocks())
+    """
+    scored_blocks = _unique_blocks(scored_blocks)
+    if isinstance(scored_blocks, list) and any(score > 0 for _, score in scored_blocks):
+        if approximate:
+            prompt_tokens = sum(TOKEN_ESTIMATOR.upper_bound(step, '.txt') for step in prompt_steps)
         else:
-            steps.append(optimized_block)
+            prompt_tokens = sum(TOKEN_COUNTER.count_many(prompt_steps))
+        optimized = {}
+        selected = select_blocks_for_budget(scored_blocks, limit - prompt_tokens, approximate, optimized, stats,
+                                            reserve=truncation_note_tokens())
+        # Relevant blocks left out are reported like steps cut at the limit
+        dropped = len(selected) < len(scored_blocks)
+        scored_blocks = selected
+    else:
+        optimized = None
+        dropped = False
+    
+    candidates = itertools.chain(((step, '.txt') for step in prompt_steps),
+                                 _block_steps(scored_blocks, approximate, optimized, stats),
+                                 [(TRUNCATION_NOTE, '.txt')] if dropped else [])
     
     # Enforce total token limit
-    total_tokens = sum(tokenize(step) for step in steps)
-    if total_tokens > MAX_TOKEN_LIMIT:
-        # Trim steps to fit within limit
-        trimmed_steps = []
-        current_total = 0
+    return iter_admitted_steps(candidates, limit, approximate)
+
+def select_blocks_for_budget(scored_blocks: List[Tuple[CodeBlock, float]], budget: int,
+                             approximate: bool = False, optimized: Optional[Dict] = None,
+                             stats: Optional[Dict] = None, reserve: int = 0) -> List[Tuple[CodeBlock, float]]:
+    """The ranked blocks whose total relevance is highest among the sets that fit budget.
+    
+    Each block costs the tokens of its optimized text and relevance header,
+    taken from block.tokens where an earlier run or the block index already
+    counted it. In exact mode the rest are counted now and remembered; in
+    approximate mode they are bounded by the estimator. The chosen blocks
+    keep their ranked order. If no block fits on its own, the ranking is
+    returned unchanged so the first block is cut at the budget as before.
+    If some blocks are left out, the set is chosen within budget - reserve
+    instead, leaving room for the TRUNCATION_NOTE that says so.
+    
+    optimized, if given, receives the (optimized text, file type) of each
+    block optimized here, keyed by id(block), for _block_steps() to reuse,
+    and stats the byte totals of that optimization.
+    """
+    if optimized is None:
+        optimized = {}
+    weights = []
+    uncounted = []
+    for i, (block, relevance) in enumerate(scored_blocks):
+        header = _relevance_header(relevance)
+        if approximate:
+            header_tokens = TOKEN_ESTIMATOR.upper_bound(header, '.txt') if header else 0
+        else:
+            header_tokens = TOKEN_COUNTER.count(header) if header else 0
+        weights.append(header_tokens)
+        if isinstance(block, CodeBlock) and block.tokens is not None:
+            weights[i] += block.tokens
+        else:
+            uncounted.append(i)
+    
+    for i, result in zip(uncounted, _optimize_blocks([scored_blocks[i][0] for i in uncounted], stats)):
+        optimized[id(scored_blocks[i][0])] = result
+    if approximate:
+        for i in uncounted:
+            optimized_block, file_type = optimized[id(scored_blocks[i][0])]
+            weights[i] += TOKEN_ESTIMATOR.upper_bound(optimized_block, file_type)
+    elif uncounted:
+        counts = TOKEN_COUNTER.count_many([optimized[id(scored_blocks[i][0])][0] for i in uncounted])
+        for i, tokens in zip(uncounted, counts):
+            weights[i] += tokens
+            block = scored_blocks[i][0]
+            if isinstance(block, CodeBlock):
+                block.tokens = tokens
+        if BLOCK_INDEX is not None:
+            try:
+                BLOCK_INDEX.record_tokens(scored_blocks[i][0] for i in uncounted if isinstance(scored_blocks[i][0], CodeBlock))
+            except Exception as e:
+                print(f"Warning: Could not save token counts to block index: {e}")
+    
+    weights = [max(weight, 1) for weight in weights]
+    values = [score for _, score in scored_blocks]
+    chosen = knapsack_select(weights, values, budget)
+    if reserve and chosen and len(chosen) < len(scored_blocks):
+        chosen = knapsack_select(weights, values, budget - reserve)
+    if not chosen:
+        return scored_blocks
+    return [scored_blocks[i] for i in chosen]
+
+def _unique_blocks(scored_blocks: Iterable[Tuple[CodeBlock, float]]) -> Iterable[Tuple[CodeBlock, float]]:
+    """scored_blocks without repeated blocks if DEDUPLICATE_BLOCKS is on; lists stay lists."""
+    if not DEDUPLICATE_BLOCKS:
+        return scored_blocks
+    unique = iter_unique_blocks(scored_blocks)
+    return list(unique) if isinstance(scored_blocks, list) else unique
+
+def _relevance_header(relevance: float) -> str:
+    """Comment put before a block that matched the prompt's keywords."""
+    if relevance > 0:
+        return f"\n# Relevance Score: {relevance:.2f} - This code matches your keywords\n"
+    return ""
+
+def block_language(block) -> Optional[str]:
+    """The language a block was extracted as, or None for plain strings such as binary analysis output."""
+    return block.language if isinstance(block, CodeBlock) else None
+
+def _optimize_blocks(blocks: list, stats: Optional[Dict] = None) -> List[Tuple[str, Optional[str]]]:
+    """Each block's optimized text and the language it was optimized as."""
+    languages = [block_language(block) for block in blocks]
+    return list(zip(optimize_code_blocks([(block_text(block), language) for block, language in zip(blocks, languages)],
+                                         stats),
+                    languages))
+
+def _block_steps(scored_blocks: Iterable[Tuple[CodeBlock, float]], approximate: bool,
+                 optimized: Optional[Dict] = None, stats: Optional[Dict] = None):
+    """Yield (step, file type) pairs for code blocks, optimizing them a batch at a time.
+    
+    optimized maps id(block) to an (optimized text, file type) pair already
+    produced by select_blocks_for_budget(); stats receives the byte totals
+    of optimizing the rest.
+    """
+    for _, steps, file_type in _block_step_groups(scored_blocks, approximate, optimized, stats):
         for step in steps:
-            step_tokens = tokenize(step)
-            if current_total + step_tokens <= MAX_TOKEN_LIMIT:
-                trimmed_steps.append(step)
-                current_total += step_tokens
-            else:
-                # Add a final note about truncation
-                trimmed_steps.append("... [Additional content truncated due to token limit]")
-                break
-        steps = trimmed_steps
+            yield step, file_type
+
+def _block_step_groups(scored_blocks: Iterable[Tuple[CodeBlock, float]], approximate: bool,
+                       optimized: Optional[Dict] = None, stats: Optional[Dict] = None):
+    """Yield (block, steps, file type) for each code block, as _block_steps() splits it."""
+    for batch in _growing_batches(scored_blocks):
+        # Optimize every block of the batch first so they can be encoded together
+        block_texts = []
+        block_languages = []
+        header_lengths = []
+        fresh = [block for block, _ in batch if not (optimized and id(block) in optimized)]
+        results = dict(zip(map(id, fresh), _optimize_blocks(fresh, stats)))
+        for block, relevance in batch:
+            optimized_block, file_type = results[id(block)] if id(block) in results else optimized[id(block)]
+            
+            # Add relevance score comment if available
+            relevance_header = _relevance_header(relevance)
+            optimized_block = relevance_header + optimized_block
+            header_lengths.append(len(relevance_header))
+            block_texts.append(optimized_block)
+            block_languages.append(file_type)
+        
+        # Split oversized blocks at line breaks (or words), reusing the batch encoding
+        if approximate:
+            for (block, _), optimized_block, file_type in zip(batch, block_texts, block_languages):
+                yield block, split_text_by_estimate(optimized_block, MAX_TOKENS_PER_STEP, file_type), file_type
+        else:
+            block_tokens = TOKEN_COUNTER.encode_many(block_texts) if TOKEN_COUNTER.encoding is not None else [None] * len(block_texts)
+            for (block, _), optimized_block, file_type, tokens, header_length in zip(
+                    batch, block_texts, block_languages, block_tokens, header_lengths):
+                if tokens is not None and not isinstance(block, str):
+                    # The header never merges with the block's first token, so its count can be taken off
+                    header_tokens = TOKEN_COUNTER.count(optimized_block[:header_length]) if header_length else 0
+                    block.tokens = len(tokens) - header_tokens
+                yield block, split_text_by_tokens(optimized_block, MAX_TOKENS_PER_STEP, tokens=tokens), file_type
+            if BLOCK_INDEX is not None:
+                try:
+                    BLOCK_INDEX.record_tokens(block for block, _ in batch if isinstance(block, CodeBlock))
+                except Exception as e:
+                    print(f"Warning: Could not save token counts to block index: {e}")
+
+def steps_for_budgets(prompt_steps: List[str], scored_blocks: Iterable[Tuple[CodeBlock, float]],
+                      budgets: Iterable[int], approximate: bool = False,
+                      stats: Optional[Dict] = None) -> Dict[int, List[str]]:
+    """The steps iter_steps() would produce for each of several token limits, from one pass.
     
-    return steps if steps else ["No content to process"]
+    Repeated blocks are skipped as in iter_steps(), and the rest are
+    optimized, split and counted once. Unranked blocks form one
+    sequence of steps, and each budget keeps the prefix whose cumulative
+    token count fits, found by bisecting the prefix sums; blocks are only
+    drawn until the largest budget is exceeded. A ranked list is narrowed
+    per budget by knapsack_select() over the same counts, ending with
+    TRUNCATION_NOTE if blocks were left out, and each selection is cut the
+    same way. With approximate set, blocks are split
+    and weighed on the upper bounds of their estimates instead, and each
+    budget's steps are cut by iter_admitted_steps(), which counts the steps
+    it keeps exactly.
+    
+    Args:
+        prompt_steps: Steps from build_prompt_steps()
+        scored_blocks: (block, relevance_score) pairs in priority order
+        budgets: Token limits, e.g. the context windows of the target models
+        approximate: Estimate token counts away from each budget's edge
+        stats: Optional dict that receives the strip_code() byte totals, as in iter_steps()
+        
+    Returns:
+        Dict from each budget to its list of steps
+    """
+    budgets = sorted(set(budgets))
+    if not budgets:
+        return {}
+    scored_blocks = _unique_blocks(scored_blocks)
+    ranked = isinstance(scored_blocks, list) and any(score > 0 for _, score in scored_blocks)
+    if approximate:
+        prompt_counts = [TOKEN_ESTIMATOR.upper_bound(step, '.txt') for step in prompt_steps]
+    else:
+        prompt_counts = TOKEN_COUNTER.count_many(prompt_steps)
+    total = sum(prompt_counts)
+    
+    groups = []  # (relevance, steps, file type, step token counts) per block, in priority order
+    relevance = {id(block): score for block, score in scored_blocks} if ranked else {}
+    for block, steps, file_type in _block_step_groups(scored_blocks, approximate, None, stats):
+        if approximate:
+            counts = [TOKEN_ESTIMATOR.upper_bound(step, file_type) for step in steps]
+        else:
+            counts = TOKEN_COUNTER.count_many(steps)
+        groups.append((relevance.get(id(block), 0.0), steps, file_type, counts))
+        total += sum(counts)
+        if not ranked and total > budgets[-1]:
+            break
+    
+    def cut(selected, budget, dropped):
+        note = [TRUNCATION_NOTE] if dropped else []
+        if approximate:
+            candidates = itertools.chain(((step, '.txt') for step in prompt_steps),
+                                         ((step, file_type) for _, group_steps, file_type, _ in selected
+                                          for step in group_steps),
+                                         ((step, '.txt') for step in note))
+            return list(iter_admitted_steps(candidates, budget, approximate))
+        steps = list(prompt_steps)
+        counts = list(prompt_counts)
+        for _, group_steps, _, group_counts in selected:
+            steps.extend(group_steps)
+            counts.extend(group_counts)
+        steps.extend(note)
+        counts.extend(truncation_note_tokens() for _ in note)
+        totals = list(itertools.accumulate(counts))
+        if bisect.bisect_right(totals, budget) == len(steps):
+            return steps
+        # Cut so that TRUNCATION_NOTE fits too
+        kept = bisect.bisect_right(totals, budget - truncation_note_tokens())
+        return steps[:kept] + [TRUNCATION_NOTE]
+    
+    result = {}
+    prompt_total = sum(prompt_counts)
+    weights = [max(sum(counts), 1) for _, _, _, counts in groups]
+    values = [score for score, _, _, _ in groups]
+    for budget in budgets:
+        selected = groups
+        if ranked:
+            chosen = knapsack_select(weights, values, budget - prompt_total)
+            if chosen and len(chosen) < len(groups):
+                # Leave room for the note saying relevant blocks were left out
+                chosen = knapsack_select(weights, values, budget - prompt_total - truncation_note_tokens())
+            if chosen:
+                selected = [groups[i] for i in chosen]
+        result[budget] = cut(selected, budget, len(selected) < len(groups))
+    return result
+
+def parse_budgets(text: str) -> List[int]:
+    """Token budgets from a comma- or space-separated list such as "2500, 8k", in the order given.
+    
+    Raises:
+        ValueError: If an entry is not a positive whole number (optionally
+            with a k suffix for thousands), or no budget is given
+    """
+    budgets = []
+    for part in re.split(r'[,\s]+', text.strip()):
+        if not part:
+            continue
+        budget = int(part[:-1]) * 1000 if part.lower().endswith('k') else int(part)
+        if budget <= 0:
+            raise ValueError(f"token budgets must be positive, got {part}")
+        if budget not in budgets:
+            budgets.append(budget)
+    if not budgets:
+        raise ValueError("no token budget given")
+    return budgets
 
 class TokenizerGUI:
     def __init__(self, master):
@@ -828,7 +3688,7 @@ class TokenizerGUI:
         self.prompt_text.config(yscrollcommand=prompt_scrollbar.set)
         
         # File selection section
-        ttk.Label(main_frame, text="Select Code File (optional):").pack(anchor="w", pady=(10, 5))
+        ttk.Label(main_frame, text="Select Code File or Folder (optional):").pack(anchor="w", pady=(10, 5))
         
         file_frame = ttk.Frame(main_frame)
         file_frame.pack(fill=tk.X, pady=5)
@@ -837,8 +3697,11 @@ class TokenizerGUI:
         self.file_entry = ttk.Entry(file_frame, textvariable=self.file_path_var, style="TEntry")
         self.file_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 5))
         
+        browse_folder_button = ttk.Button(file_frame, text="Browse Folder", command=self.browse_folder)
+        browse_folder_button.pack(side=tk.RIGHT)
+        
         browse_button = ttk.Button(file_frame, text="Browse", command=self.browse_file)
-        browse_button.pack(side=tk.RIGHT)
+        browse_button.pack(side=tk.RIGHT, padx=(0, 5))
         
         # Action buttons
         button_frame = ttk.Frame(main_frame)
@@ -850,6 +3713,12 @@ class TokenizerGUI:
         self.copy_button = ttk.Button(button_frame, text="Copy to Clipboard", command=self.copy_to_clipboard)
         self.copy_button.pack(side=tk.LEFT)
         
+        # Token budgets, e.g. the context windows of the target models
+        ttk.Label(button_frame, text="Token budgets:").pack(side=tk.LEFT, padx=(10, 0))
+        self.budgets_var = tk.StringVar(value=str(MAX_TOKEN_LIMIT))
+        budgets_entry = ttk.Entry(button_frame, textvariable=self.budgets_var, width=18, style="TEntry")
+        budgets_entry.pack(side=tk.LEFT)
+        
         # Token counter
         self.token_label = ttk.Label(button_frame, text="Tokens: 0")
         self.token_label.pack(side=tk.RIGHT)
@@ -858,8 +3727,17 @@ class TokenizerGUI:
         self.status_bar = ttk.Label(main_frame, text="Ready", anchor="w")
         self.status_bar.pack(side=tk.BOTTOM, fill=tk.X, pady=(5, 0))
         
-        # Output section
-        ttk.Label(main_frame, text="Optimized Steps:").pack(anchor="w", pady=(10, 5))
+        # Output section, with a selector for the budget whose steps are shown
+        output_header = ttk.Frame(main_frame)
+        output_header.pack(fill=tk.X, pady=(10, 5))
+        ttk.Label(output_header, text="Optimized Steps:").pack(side=tk.LEFT)
+        self.budget_choice = ttk.Combobox(output_header, state="readonly", width=10)
+        self.budget_choice.pack(side=tk.RIGHT)
+        self.budget_choice.bind("<<ComboboxSelected>>", self.show_selected_budget)
+        ttk.Label(output_header, text="Show budget:").pack(side=tk.RIGHT)
+        self.budget_results = {}  # Budget -> steps of the last optimization
+        self.result_info = ("Basic", False)  # (parser used, approximate) of the last optimization
+        self.strip_summary = ""  # describe_strip_stats() of the last optimization
         
         self.output_frame = ttk.Frame(main_frame)
         self.output_frame.pack(fill=tk.BOTH, expand=True, pady=5)
@@ -872,17 +3750,15 @@ class TokenizerGUI:
         output_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         self.output_text.config(yscrollcommand=output_scrollbar.set)
         
+        # Live token counting state
+        self.live_token_counter = LiveTokenCounter(TOKEN_COUNTER)
+        self._token_count_job = None
+        self._token_count_generation = 0
+        
         # Initial focus and bindings
         self.prompt_text.focus_set()
         self.prompt_text.bind("<KeyRelease>", self.update_token_count)
         
-        # Word list for autocomplete
-        self.word_list = set()
-        try:
-            self.word_list = set(words.words())
-        except:
-            print("Warning: NLTK words corpus not available")
-            
         # Add programming keywords to autocomplete
         programming_keywords = {
             "function", "class", "import", "from", "def", "return", "if", "else", "elif",
@@ -890,20 +3766,52 @@ class TokenizerGUI:
             "break", "continue", "pass", "raise", "True", "False", "None", "lambda",
             "global", "nonlocal", "yield", "assert", "del", "in", "is", "not", "and", "or"
         }
-        self.word_list.update(programming_keywords)
+        
+        # Word list for autocomplete; the NLTK corpus joins it once loaded in the background
+        self.word_list = set(programming_keywords)
+        threading.Thread(target=self._load_word_list_thread, args=(programming_keywords,), daemon=True).start()
         
         # Suggestions for autocomplete
         self.current_suggestions = []
         self.suggestion_index = 0
 
+    def _load_word_list_thread(self, programming_keywords: set):
+        """Load the NLTK word list without holding up the window."""
+        try:
+            word_list = load_word_list()
+        except Exception:
+            print("Warning: NLTK words corpus not available")
+            return
+        word_list.update(programming_keywords)
+        self.word_list = word_list
+    
     def update_token_count(self, event=None):
-        """Update the token count in real-time."""
+        """Schedule a token count update once typing pauses."""
+        if self._token_count_job is not None:
+            self.master.after_cancel(self._token_count_job)
+        self._token_count_job = self.master.after(LIVE_COUNT_DEBOUNCE_MS, self._start_token_count)
+
+    def _start_token_count(self):
+        """Hand the current prompt to a background thread for counting."""
+        self._token_count_job = None
+        text = self.prompt_text.get("1.0", tk.END)
+        self._token_count_generation += 1
+        threading.Thread(target=self._token_count_thread,
+                         args=(text, self._token_count_generation), daemon=True).start()
+
+    def _token_count_thread(self, text, generation):
+        """Thread function for counting tokens without blocking typing."""
         try:
-            text = self.prompt_text.get("1.0", tk.END)
-            count = tokenize(text)
-            self.token_label.config(text=f"Tokens: {count}")
+            count = self.live_token_counter.count(text)
         except Exception as e:
             print(f"Error counting tokens: {e}")
+            return
+        self.master.after(0, lambda: self._show_token_count(count, generation))
+
+    def _show_token_count(self, count, generation):
+        """Show a finished count unless a newer one has been requested since."""
+        if generation == self._token_count_generation:
+            self.token_label.config(text=f"Tokens: {count}")
 
     def autocomplete(self, event):
         """Handle autocomplete with Tab key."""
@@ -991,6 +3899,14 @@ class TokenizerGUI:
             file_name = os.path.basename(file_path)
             self.status_bar.config(text=f"File selected: {file_name}")
 
+    def browse_folder(self):
+        """Open a directory dialog to select a repository to analyze."""
+        folder_path = filedialog.askdirectory()
+        if folder_path:
+            self.file_path_var.set(folder_path)
+            # Update status bar
+            self.status_bar.config(text=f"Folder selected: {os.path.basename(folder_path) or folder_path}")
+
     def optimize(self):
         """Process the prompt and code file to generate optimized steps."""
         prompt = self.prompt_text.get("1.0", tk.END).strip()
@@ -999,6 +3915,12 @@ class TokenizerGUI:
         if not prompt:
             messagebox.showerror("Error", "Please enter a prompt.")
             return
+        
+        try:
+            budgets = parse_budgets(self.budgets_var.get())
+        except ValueError as e:
+            messagebox.showerror("Error", f"Invalid token budgets: {e}")
+            return
             
         # Disable UI during processing
         self.optimize_button.config(state="disabled")
@@ -1006,12 +3928,11 @@ class TokenizerGUI:
         self.master.update()
         
         # Use threading to keep the UI responsive
-        threading.Thread(target=self._optimize_thread, args=(prompt, file_path), daemon=True).start()
+        threading.Thread(target=self._optimize_thread, args=(prompt, file_path, budgets), daemon=True).start()
     
-    def _optimize_thread(self, prompt, file_path):
+    def _optimize_thread(self, prompt, file_path, budgets):
         """Thread function for optimization to prevent UI freezing."""
         try:
-            blocks = []
             parser_used = "Basic"
             
             # Extract keywords and filter blocks by relevance
@@ -1022,16 +3943,51 @@ class TokenizerGUI:
             keyword_info = f"Keywords found: {', '.join(keywords)}" if keywords else "No specific keywords found"
             self.master.after(0, lambda: self.status_bar.config(text=keyword_info))
             
-            if file_path and os.path.exists(file_path):
+            has_folder = bool(file_path) and os.path.isdir(file_path)
+            has_file = bool(file_path) and os.path.isfile(file_path)
+            if has_folder:
+                self.master.after(0, lambda: self.status_bar.config(text="Listing repository files..."))
+                repository_files = list(iter_repository_files(file_path))
+                input_size = sum(os.path.getsize(path) for path in repository_files)
+            else:
+                input_size = os.path.getsize(file_path) if has_file else 0
+            approximate = should_estimate_tokens(prompt, input_size=input_size)
+            blocks_kept = max(budgets)  # As RELEVANT_BLOCKS_KEPT is for MAX_TOKEN_LIMIT
+            strip_stats = {}  # File type -> strip_code() byte totals of the blocks optimized
+            if approximate and has_folder:
+                calibrate_estimator(sample_input_files(repository_files))
+            
+            # The prompt's steps lead the output, so show them early. Only they appear
+            # before the file is read and decoded in full; block steps follow once
+            # extraction (and, with keywords, scoring of every block) has run
+            prompt_steps = build_prompt_steps(prompt, approximate)
+            self.master.after(0, lambda: self._update_ui_after_optimize(prompt_steps, parser_used, approximate, final=False))
+            
+            if has_folder:
+                processes = min(EXTRACT_PROCESSES, max(1, len(repository_files)))
+                parser_used = f"Repository mode ({len(repository_files)} files, {processes} processes)"
+                
+                def show_progress(done, total):
+                    if done == total or done % 50 == 0:
+                        self.master.after(0, lambda: self.status_bar.config(text=f"Extracted {done} of {total} files..."))
+                
+                counts = {}
+                scored_blocks = rank_repository_blocks(file_path, repository_files, keywords, blocks_kept,
+                                                       processes, counts, show_progress)
+                if counts['relevant']:
+                    self.master.after(0, lambda: self.status_bar.config(
+                        text=f"Found {counts['relevant']} relevant code blocks out of {counts['blocks']} blocks "
+                             f"in {counts['files']} files"))
+                else:
+                    self.master.after(0, lambda: self.status_bar.config(
+                        text=f"No keyword matches found. Processing blocks of {counts['files']} files in path order."))
+                results = self._generate_steps(prompt_steps, scored_blocks, approximate, parser_used, budgets, strip_stats)
+            elif has_file:
                 # Check if it's a binary file
-                is_binary = False
-                try:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        f.read(1024)  # Try to read a bit of the file
-                except UnicodeDecodeError:
-                    is_binary = True
+                self.master.after(0, lambda: self.status_bar.config(text="Reading file..."))
+                source, content = open_source_file(file_path)
                 
-                if is_binary:
+                if source is None:
                     self.master.after(0, lambda: self.status_bar.config(text="Analyzing binary file... This may take a while."))
                     
                     # Update the status bar to show we're using Ghidra if available
@@ -1040,53 +3996,61 @@ class TokenizerGUI:
                     
                     blocks = analyze_binary_file(file_path)
                     parser_used = "Ghidra Decompiler" if GHIDRA_HEADLESS_PATH and blocks and "Ghidra Decompilation" in blocks[0] else "Binary Analysis"
+                    
+                    # Size estimates on the analysis output rather than on the binary itself
+                    approximate = should_estimate_tokens(prompt, blocks)
+                    if approximate:
+                        calibrate_estimator({None: sample_texts(blocks)})
+                    prompt_steps = build_prompt_steps(prompt, approximate)
                 else:
                     # It's a text file, process normally
+                    if approximate:
+                        calibrate_estimator(sample_input_files([file_path]))
                     self.master.after(0, lambda: self.status_bar.config(text="Extracting code blocks..."))
-                    blocks = extract_code_blocks(file_path)
+                    blocks = iter_code_blocks(file_path, content, source)
+                    content = None  # Blocks decode their text from the source from here on
                     
                     # Update parser_used based on file extension and what was used
                     ext = os.path.splitext(file_path)[1].lower()
                     parser_map = {
-                        '.py': "AST" if "ast" in sys.modules else "Regex",
-                        '.js': "Esprima" if "esprima" in sys.modules else "Regex",
-                        '.html': "BeautifulSoup" if "bs4" in sys.modules else "Regex",
-                        '.java': "Javalang" if "javalang" in sys.modules else "Regex",
-                        '.c': "PyCParser" if "pycparser" in sys.modules else "Regex",
-                        '.css': "CSSParser" if "cssparser" in sys.modules else "Regex"
+                        '.py': "AST",
+                        '.js': "Esprima" if is_module_available("esprima") else "Regex",
+                        '.html': "BeautifulSoup" if is_module_available("bs4") else "Regex",
+                        '.java': "Javalang" if is_module_available("javalang") else "Regex",
+                        '.c': "PyCParser" if is_module_available("pycparser") else "Regex",
+                        '.css': "CSSParser" if is_module_available("cssparser") else "Regex"
                     }
                     
                     # Try to update parser used
-                    parser_used = parser_map.get(ext, "Tree-sitter" if "tree_sitter" in sys.modules else "Regex")
+                    parser_used = parser_map.get(ext, "Tree-sitter" if is_module_available("tree_sitter") else "Regex")
                 
-                # Filter and score blocks based on keywords
-                scored_blocks = filter_relevant_blocks(blocks, keywords)
-                
-                # If we have relevant blocks, show how many were selected
-                if scored_blocks and any(score > 0 for _, score in scored_blocks):
-                    relevant_count = sum(1 for _, score in scored_blocks if score > 0)
-                    total_count = len(blocks)
-                    self.master.after(0, lambda: self.status_bar.config(
-                        text=f"Found {relevant_count} relevant code blocks out of {total_count} total blocks"))
+                if keywords:
+                    # Score every block, keeping only as many of the best as could ever fit;
+                    # the first block step can only be shown once all are scored
+                    counts = {}
+                    scored_blocks = select_relevant_blocks(blocks, keywords, blocks_kept, counts)
                     
-                    # Sort blocks by relevance and keep original blocks for reference
-                    relevance_scores = [score for _, score in scored_blocks]
-                    filtered_blocks = [block for block, _ in scored_blocks]
+                    # If we have relevant blocks, show how many were selected
+                    if counts['relevant']:
+                        self.master.after(0, lambda: self.status_bar.config(
+                            text=f"Found {counts['relevant']} relevant code blocks out of {counts['blocks']} total blocks"))
+                    else:
+                        self.master.after(0, lambda: self.status_bar.config(
+                            text=f"No keyword matches found. Processing all {counts['blocks']} blocks."))
                 else:
+                    # Nothing to rank by: blocks stream straight into steps until the budget is full
                     self.master.after(0, lambda: self.status_bar.config(
-                        text=f"No keyword matches found. Processing all {len(blocks)} blocks."))
-                    filtered_blocks = blocks
-                    relevance_scores = [0.0] * len(blocks)
+                        text="No keywords found. Processing blocks in file order."))
+                    scored_blocks = ((block, 0.0) for block in blocks)
                 
-                # Generate final steps with relevance information
-                self.master.after(0, lambda: self.status_bar.config(text="Generating optimized steps..."))
-                steps = generate_steps(prompt, filtered_blocks, relevance_scores)
+                results = self._generate_steps(prompt_steps, scored_blocks, approximate, parser_used, budgets, strip_stats)
             else:
                 # No file, just process the prompt
-                steps = generate_steps(prompt)
+                results = self._generate_steps(prompt_steps, (), approximate, parser_used, budgets, strip_stats)
+            results = {budget: steps or ["No content to process"] for budget, steps in results.items()}
             
             # Update UI in the main thread
-            self.master.after(0, lambda: self._update_ui_after_optimize(steps, parser_used))
+            self.master.after(0, lambda: self._show_budget_results(results, parser_used, approximate, strip_stats))
         
         except Exception as e:
             import traceback
@@ -1094,8 +4058,52 @@ class TokenizerGUI:
         finally:
             self.master.after(0, lambda: self.optimize_button.config(state="normal"))
 
-    def _update_ui_after_optimize(self, steps, parser_used):
-        """Update the UI with optimization results."""
+    def _generate_steps(self, prompt_steps, scored_blocks, approximate, parser_used, budgets, stats=None):
+        """Steps for each budget, in the order the budgets were given; a single budget is streamed."""
+        if len(budgets) == 1:
+            return {budgets[0]: self._stream_steps(prompt_steps, scored_blocks, approximate, parser_used,
+                                                   budgets[0], stats)}
+        self.master.after(0, lambda: self.status_bar.config(
+            text=f"Generating optimized steps for {len(budgets)} budgets..."))
+        results = steps_for_budgets(prompt_steps, scored_blocks, budgets, approximate, stats)
+        return {budget: results[budget] for budget in budgets}
+
+    def _stream_steps(self, prompt_steps, scored_blocks, approximate, parser_used, limit=MAX_TOKEN_LIMIT, stats=None):
+        """Generate final steps with relevance information, showing them as they are admitted."""
+        self.master.after(0, lambda: self.status_bar.config(text="Generating optimized steps..."))
+        steps = []
+        last_update = time.monotonic()
+        for step in iter_steps(prompt_steps, scored_blocks, approximate, limit, stats):
+            steps.append(step)
+            if time.monotonic() - last_update >= STEP_STREAM_INTERVAL:
+                last_update = time.monotonic()
+                self.master.after(0, lambda partial=list(steps): self._update_ui_after_optimize(
+                    partial, parser_used, approximate, final=False))
+        return steps
+
+    def _show_budget_results(self, results, parser_used, approximate, strip_stats=None):
+        """Offer each budget's steps in the budget selector and show the first budget's."""
+        self.budget_results = results
+        self.result_info = (parser_used, approximate)
+        self.strip_summary = describe_strip_stats(strip_stats or {})
+        self.budget_choice.config(values=[str(budget) for budget in results])
+        self.budget_choice.set(str(next(iter(results))))
+        self.show_selected_budget()
+
+    def show_selected_budget(self, event=None):
+        """Show the steps of the budget picked in the budget selector."""
+        if not self.budget_results:
+            return
+        budget = int(self.budget_choice.get())
+        parser_used, approximate = self.result_info
+        self._update_ui_after_optimize(self.budget_results[budget], parser_used, approximate, budget=budget)
+
+    def _update_ui_after_optimize(self, steps, parser_used, approximate=False, final=True, budget=None):
+        """Update the UI with optimization results.
+        
+        With final unset this shows the steps produced so far, without totals.
+        budget, if given, is the token limit the steps were fitted to.
+        """
         self.output_text.delete("1.0", tk.END)
         
         # Add a header with info about the processor used
@@ -1107,11 +4115,22 @@ class TokenizerGUI:
             self.output_text.insert(tk.END, step_header)
             self.output_text.insert(tk.END, step + "\n\n")
         
-        total_tokens = sum(tokenize(step) for step in steps)
-        footer = f"\n=== TOTAL TOKENS: {total_tokens} ===\n"
+        if not final:
+            self.output_text.insert(tk.END, "... (processing)\n")
+            return
+        
+        total_tokens, token_error = count_steps_with_error(steps, approximate)
+        budget_note = f" of {budget} budget" if budget is not None else ""
+        if token_error:
+            footer = f"\n=== TOTAL TOKENS: ~{total_tokens}{budget_note} (±{token_error}, estimated) ===\n"
+        else:
+            footer = f"\n=== TOTAL TOKENS: {total_tokens}{budget_note} ===\n"
         self.output_text.insert(tk.END, footer)
         
-        self.status_bar.config(text=f"Optimization complete. Using {parser_used}. Total tokens: {total_tokens}")
+        status = f"Optimization complete. Using {parser_used}. Total tokens: {total_tokens}"
+        if self.strip_summary:
+            status += f". {self.strip_summary}"
+        self.status_bar.config(text=status)
         
         # Scroll to the top of the output
         self.output_text.see("1.0")
@@ -1225,13 +4244,7 @@ class TokenizerGUI:
             self.status_bar.config(background=THEME_BG, foreground=THEME_FG)
 
 def main():
-    # Check if running as bundled executable
-    if getattr(sys, 'frozen', False):
-        # If we're running as a PyInstaller bundle
-        application_path = os.path.dirname(sys.executable)
-    else:
-        # If we're running as a script
-        application_path = os.path.dirname(os.path.abspath(__file__))
+    application_path = get_application_path()
         
     # Set up logging
     import logging
@@ -1239,9 +4252,15 @@ def main():
     logging.basicConfig(filename=log_file, level=logging.INFO,
                         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     
-    # Look for Ghidra if not already found
-    if not GHIDRA_HEADLESS_PATH:
-        find_ghidra()
+    # Ghidra and grammar locations come from the cached profile; the system
+    # is only probed on the first launch or after it has changed
+    load_environment_profile(application_path, refresh="--rescan-environment" in sys.argv)
+    
+    # Blocks of files already seen are served from the index instead of reparsing
+    global BLOCK_INDEX
+    BLOCK_INDEX = open_block_index(application_path)
+    if BLOCK_INDEX is not None and "--rebuild-index" in sys.argv:
+        BLOCK_INDEX.clear()
     
     # Create main window
     root = tk.Tk()
@@ -1311,7 +4330,16 @@ def main():
     # Initialize the application
     app = TokenizerGUI(root)
     
+    global STARTUP_SECONDS
+    STARTUP_SECONDS = time.perf_counter() - _STARTUP_BEGIN
+    if "--import-report" in sys.argv:
+        # Printed on exit so libraries first used during the session are included
+        atexit.register(print_import_report)
+    
     root.mainloop()
 
 if __name__ == "__main__":
+    # Repository mode starts worker processes; frozen executables must handle them here
+    import multiprocessing
+    multiprocessing.freeze_support()
     main() 
\ No newline at end of file